@@ -7,6 +7,16 @@ from .persistence import (
     FilePersistenceWithDataProtection,
     KeychainPersistence,
     LibsecretPersistence,
+    BaseEntryPersistence,
     )
-from .token_cache import PersistedTokenCache, CrossPlatLock, LockError
+from .symmetric_persistence import FilePersistenceWithSymmetricKey
+from .sqlite_persistence import SqlitePersistence
+from .directory_persistence import DirectoryPersistence
+from .token_cache import (
+    PersistedTokenCache, CrossPlatLock, CrossPlatReadWriteLock, LockError)
+from .lock_policy import LockPolicy
 
+from .async_token_cache import AsyncPersistedTokenCache, AsyncCrossPlatLock
+from .sharded_token_cache import ShardedPersistedTokenCache
+from .shared_memory import SharedMemoryPersistence
+from .daemon import TokenCacheDaemon, DaemonPersistence
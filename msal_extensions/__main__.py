@@ -0,0 +1,51 @@
+"""Runs a token cache daemon.
+
+Usage: python -m msal_extensions [--address PATH] [--encrypted] [--indexed] LOCATION
+
+Runs a daemon which serves the token cache persisted at LOCATION
+to local processes, which would use DaemonPersistence, until it is terminated.
+"""
+import argparse
+import logging
+import signal
+import sys
+
+from .persistence import FilePersistence, build_encrypted_persistence
+from .daemon import TokenCacheDaemon
+
+
+def main(argv=None):
+    """Parse the command line arguments, and serve until terminated"""
+    parser = argparse.ArgumentParser(
+        prog="python -m msal_extensions",
+        description="Runs a daemon which serves a token cache to local processes.")
+    parser.add_argument("location", help="The location of the token cache")
+    parser.add_argument(
+        "--address", help="The path of the socket. Defaults to LOCATION.sock")
+    parser.add_argument(
+        "--encrypted", action="store_true",
+        help="Use the encrypted persistence of current platform")
+    parser.add_argument(
+        "--indexed", action="store_true", help="Index the token cache in memory")
+    parser.add_argument(
+        "--purge-expired-after", type=float,
+        help="Remove access tokens expired for more than this many seconds")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    persistence = (build_encrypted_persistence if args.encrypted else FilePersistence)(
+        args.location)
+    # So that the socket would be removed on termination, too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with TokenCacheDaemon(
+            persistence, address=args.address, indexed=args.indexed,
+            purge_expired_after=args.purge_expired_after) as daemon:
+        logging.info("Serving %s on %s", args.location, daemon.server_address)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
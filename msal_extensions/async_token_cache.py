@@ -0,0 +1,122 @@
+"""Asyncio counterparts of the token cache and its lock.
+
+They never block the event loop. The token cache offloads each operation,
+including its waiting for the lock, to a bounded thread pool,
+while the lock waits by ``asyncio.sleep()``.
+They use the same persistence and the same lock file as their synchronous
+counterparts, so that asyncio apps and other apps can still share a token cache.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import time
+
+from .token_cache import PersistedTokenCache, CrossPlatLock, LockError
+from .lock_policy import LockPolicy
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCrossPlatLock(object):
+    """An ``async with`` counterpart of :class:`CrossPlatLock`, using a same lock file.
+
+    Each attempt is a non-blocking one, and the waiting in between is an
+    ``asyncio.sleep()``, paced by the policy.
+    Unlike the portalocker-based :class:`CrossPlatLock`,
+    this lock always raises ``LockError`` after a timeout,
+    rather than proceeding without the lock.
+    """
+    _attempt_policy = LockPolicy(timeout=0, raise_on_timeout=True)  # Try only once
+
+    def __init__(self, lockfile_path, policy=None):
+        """
+        :param str lockfile_path: The path of the lock file.
+        :param LockPolicy policy: Defines how to wait for other holders.
+        """
+        self._lockpath = lockfile_path
+        self._policy = policy or LockPolicy()
+        self._lock = None
+        self._acquired_at = None
+
+    async def __aenter__(self):
+        deadline = time.monotonic() + self._policy.timeout
+        attempt = 0
+        blocker_modified_time = None
+        while True:
+            lock = CrossPlatLock(self._lockpath, policy=self._attempt_policy)
+            try:
+                lock.__enter__()
+            except LockError:
+                if deadline <= time.monotonic():
+                    raise LockError(
+                        "Unable to obtain lock, despite trying for {} second(s). "
+                        "You may want to manually remove the stale lock file {}".format(
+                            self._policy.timeout, self._lockpath))
+                logger.debug("Found existing lock file, will retry later")
+                interval, blocker_modified_time = self._policy.next_interval(
+                    attempt, self._lockpath)
+                await asyncio.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+                attempt += 1
+            else:
+                self._lock = lock
+                self._policy.record_acquisition(blocker_modified_time)
+                self._acquired_at = time.monotonic()
+                return self
+
+    async def __aexit__(self, *args):
+        self._policy.record_hold_time(time.monotonic() - self._acquired_at)
+        lock, self._lock = self._lock, None
+        lock.__exit__(*args)  # It merely removes and closes the lock file
+
+
+class AsyncPersistedTokenCache(object):
+    """An asyncio counterpart of :class:`PersistedTokenCache`.
+
+    It offers awaitable :func:`~search` and :func:`~modify`,
+    which behave like those of :class:`PersistedTokenCache`,
+    without ever blocking the event loop.
+    It can share a same persistence with :class:`PersistedTokenCache` instances
+    in other threads or processes.
+    Call :func:`~close` when it is no longer needed.
+    """
+    def __init__(self, persistence, lock_location=None, lock_policy=None, max_workers=4):
+        """
+        :param persistence: A persistence instance, such as ``FilePersistence``.
+        :param str lock_location:
+            Optional. Defaults to the persistence location plus ``.lockfile``.
+        :param LockPolicy lock_policy:
+            Optional. Defines how long and how often to wait for the lock.
+        :param int max_workers:
+            The size of the thread pool which each operation is offloaded to.
+        """
+        # The synchronous cache does the actual work, inside our thread pool,
+        # so that its locking, journal, daemon and other features apply as is
+        self._cache = PersistedTokenCache(
+            persistence, lock_location=lock_location, lock_policy=lock_policy)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.is_encrypted = persistence.is_encrypted
+
+    def _run(self, func, *args, **kwargs):
+        return asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+
+    async def modify(self, credential_type, old_entry, new_key_value_pairs=None):
+        """Same as ``PersistedTokenCache.modify()``, but awaitable"""
+        await self._run(
+            self._cache.modify, credential_type, old_entry,
+            new_key_value_pairs=new_key_value_pairs)
+
+    async def search(self, credential_type, **kwargs):
+        """Same as ``PersistedTokenCache.search()``, but awaitable.
+
+        :return: A list of matching entries.
+        """
+        # The search itself may remove expired tokens, which is a write.
+        # So the whole iteration is offloaded, too.
+        return await self._run(lambda: list(self._cache.search(credential_type, **kwargs)))
+
+    def close(self):
+        """Shut down the thread pool"""
+        self._executor.shutdown(wait=False)
@@ -7,6 +7,10 @@ import logging
 
 import portalocker  # pylint: disable=import-error
 
+from . import filelock
+from .filelock import _wait_for_release, _break_stale_lock, _lock_file_content
+from .lock_policy import LockPolicy
+
 
 logger = logging.getLogger(__name__)
 
@@ -19,8 +23,14 @@ class CrossPlatLock(object):
     resource. This is specifically written to interact with a class of the same name in the .NET
     extensions library.
     """
-    def __init__(self, lockfile_path):
+    def __init__(self, lockfile_path, policy=None):
+        """
+        :param str lockfile_path: The path of the lock file.
+        :param LockPolicy policy: Defines how to wait for other holders.
+        """
         self._lockpath = lockfile_path
+        self._policy = policy or LockPolicy()
+        self._acquired_at = None
         self._lock = portalocker.Lock(
             lockfile_path,
             mode='wb+',
@@ -35,35 +45,53 @@ class CrossPlatLock(object):
         )
 
     def _try_to_create_lock_file(self):
-        timeout = 5
-        check_interval = 0.25
         current_time = getattr(time, "monotonic", time.time)
-        timeout_end = current_time() + timeout
+        timeout_end = current_time() + self._policy.timeout
         pid = os.getpid()
-        while timeout_end > current_time():
+        attempt = 0
+        blocker_modified_time = None
+        while True:
             try:
                 with open(self._lockpath, 'x'):  # pylint: disable=unspecified-encoding
+                    self._policy.record_acquisition(blocker_modified_time)
                     return True
             except ValueError:  # This needs to be the first clause, for Python 2 to hit it
                 logger.warning("Python 2 does not support atomic creation of file")
                 return False
             except FileExistsError:  # Only Python 3 will reach this clause
-                logger.debug(
-                    "Process %d found existing lock file, will retry after %f second",
-                    pid, check_interval)
-                time.sleep(check_interval)
-        return False
+                if _break_stale_lock(self._lockpath):
+                    continue
+                if timeout_end <= current_time():
+                    return False
+                if not _wait_for_release(self._lockpath, timeout_end - current_time()):
+                    logger.debug(
+                        "Process %d found existing lock file, will retry later", pid)
+                    blocker_modified_time = self._policy.sleep(
+                        attempt, self._lockpath, timeout_end)
+                    attempt += 1
 
     def __enter__(self):
         pid = os.getpid()
         if not self._try_to_create_lock_file():
+            if self._policy.raise_on_timeout:
+                raise LockError(
+                    "Unable to obtain lock, despite trying for {} second(s). "
+                    "You may want to manually remove the stale lock file {}".format(
+                        self._policy.timeout, self._lockpath))
             logger.warning("Process %d failed to create lock file", pid)
         file_handle = self._lock.__enter__()
-        file_handle.write('{} {}'.format(pid, sys.argv[0]).encode('utf-8'))  # pylint: disable=consider-using-f-string
+        file_handle.write(_lock_file_content())
+        self._acquired_at = time.monotonic()
         return file_handle
 
     def __exit__(self, *args):
-        self._lock.__exit__(*args)
+        self._policy.record_hold_time(time.monotonic() - self._acquired_at)
+        # On Windows, a file can not be removed while it is still open.
+        # Elsewhere, we remove it before releasing the lock, so that the waiters,
+        # which would be woken up by the release, could create a new lock file right away.
+        remove_first = not sys.platform.startswith('win')
+        if not remove_first:
+            self._lock.__exit__(*args)
         try:
             # Attempt to delete the lockfile. In either of the failure cases enumerated below, it is
             # likely that another process has raced this one and ended up clearing or locking the
@@ -72,3 +100,29 @@ class CrossPlatLock(object):
         except OSError as ex:  # pylint: disable=invalid-name
             if ex.errno not in (errno.ENOENT, errno.EACCES):
                 raise
+        finally:
+            if remove_first:
+                self._lock.__exit__(*args)
+
+
+# It only overrides the hooks of its base class, whose public interface is a context manager
+class CrossPlatReadWriteLock(filelock.CrossPlatReadWriteLock):  # pylint: disable=too-few-public-methods
+    """A reader-writer lock, allowing either many readers or one writer at a time.
+
+    Same as :class:`filelock.CrossPlatReadWriteLock`, except that, on Windows,
+    it uses portalocker whose shared lock would let readers proceed in parallel.
+    """
+    def _try_to_lock(self, lock_file):
+        try:
+            portalocker.lock(lock_file, portalocker.LOCK_NB | (
+                portalocker.LOCK_SH if self._shared else portalocker.LOCK_EX))
+            return True
+        except LockError:
+            return False
+
+    def _unlock(self, lock_file):
+        portalocker.unlock(lock_file)
+
+    def _timeout_error(self, timeout):
+        return LockError(str(
+            super(CrossPlatReadWriteLock, self)._timeout_error(timeout)))
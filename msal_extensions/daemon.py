@@ -0,0 +1,236 @@
+"""A daemon which serves a token cache to local processes, and its client.
+
+The daemon keeps one :class:`PersistedTokenCache` in memory, and serves
+its ``search()``, ``_get()`` and ``modify()`` over a Unix domain socket,
+so that its clients need not load, parse nor lock the persistence by themselves.
+Writes are serialized by the daemon, which still holds the lock file when
+writing, so that it interoperates with processes not using the daemon.
+
+The protocol is one JSON object per line, in both directions.
+A request is ``{"op": ..., ...}``, and its response is either
+``{"result": ...}`` or ``{"error": "...", "type": "..."}``,
+whose type is the name of the exception raised by the daemon.
+
+Run it by ``python -m msal_extensions``.
+"""
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+from .persistence import (
+    BasePersistence, PersistenceError, PersistenceNotFound,
+    PersistenceEncryptionError, PersistenceDecryptionError)
+from .token_cache import PersistedTokenCache, LockError
+
+
+logger = logging.getLogger(__name__)
+
+
+# Errors which a client would re-raise as is. Others become a RuntimeError.
+_ERROR_TYPES = {error_type.__name__: error_type for error_type in (
+    LockError, PersistenceError, PersistenceNotFound,
+    PersistenceEncryptionError, PersistenceDecryptionError,
+    KeyError, TypeError, ValueError, OSError,
+    )}
+
+
+def _default_address(location):
+    return location + ".sock"
+
+
+def _rebuild_error(response):
+    # type: (dict) -> Exception
+    """Re-create the exception raised by the daemon, keeping its type when known"""
+    message = "Daemon failed: {}".format(response["error"])
+    error_type = _ERROR_TYPES.get(response.get("type"), RuntimeError)
+    if issubclass(error_type, PersistenceError):
+        return error_type(message=message)
+    return error_type(message)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:  # A connection may carry many requests
+            try:
+                response = {"result": self.server.dispatch(json.loads(line))}
+            except Exception as ex:  # pylint: disable=broad-except
+                logger.exception("Unable to serve a request")
+                response = {"error": str(ex), "type": type(ex).__name__}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class TokenCacheDaemon(
+        socketserver.ThreadingMixIn,
+        getattr(socketserver, "UnixStreamServer", object),  # Absent on Windows
+        ):
+    """Serves a token cache over a Unix domain socket. For example::
+
+        with TokenCacheDaemon(FilePersistence("token_cache.bin")) as daemon:
+            daemon.serve_forever()
+
+    Its clients would use :class:`DaemonPersistence`.
+    """
+    daemon_threads = True
+
+    def __init__(self, persistence, address=None, **kwargs):
+        """
+        :param persistence: A persistence instance, such as ``FilePersistence``.
+        :param str address:
+            Optional. The path of the socket. Defaults to the location of
+            the persistence plus ``.sock``, which shall be shorter than
+            the limit of a socket path, roughly 100 characters.
+            Only current user can connect to it.
+        :param kwargs:
+            Other parameters to be passed to :class:`PersistedTokenCache`.
+        """
+        if not hasattr(socket, "AF_UNIX"):
+            raise RuntimeError("Unix domain socket is unavailable on this platform")
+        self.cache = PersistedTokenCache(persistence, **kwargs)
+        address = address or _default_address(persistence.get_location())
+        if os.path.exists(address):
+            try:
+                with socket.socket(socket.AF_UNIX) as probe:
+                    probe.connect(address)
+            except OSError:  # Left behind by a previous daemon
+                os.remove(address)
+            else:
+                raise RuntimeError("Another daemon is serving {}".format(address))
+        super(TokenCacheDaemon, self).__init__(address, _Handler)
+
+    def server_bind(self):
+        super(TokenCacheDaemon, self).server_bind()
+        # Before server_activate() starts listening, so no one could connect before this
+        os.chmod(self.server_address, 0o600)
+
+    def dispatch(self, request):
+        # type: (dict) -> object
+        """Serve one request, and return its result"""
+        op = request["op"]
+        if op == "search":
+            return list(self.cache.search(request["credential_type"], **request["kwargs"]))
+        if op == "get":
+            self.cache._reload_if_necessary()  # pylint: disable=protected-access
+            return self.cache._get(  # pylint: disable=protected-access
+                request["credential_type"], request["key"])
+        if op == "commit":
+            self.cache._commit(  # pylint: disable=protected-access
+                [tuple(change) for change in request["changes"]])
+            return None
+        raise ValueError("Unknown op: {}".format(op))
+
+    def server_close(self):
+        super(TokenCacheDaemon, self).server_close()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+class DaemonPersistence(BasePersistence):
+    """Wraps a persistence, such as ``FilePersistence``, which is also served by
+    a :class:`TokenCacheDaemon`. An app would switch to the daemon
+    by wrapping its persistence with this. For example::
+
+        cache = PersistedTokenCache(DaemonPersistence(FilePersistence("token_cache.bin")))
+
+    Such a :class:`PersistedTokenCache` would then have its ``search()``,
+    ``_get()`` and ``modify()`` done by the daemon,
+    and with the settings of the daemon's token cache, rather than its own.
+    When the daemon is unreachable, e.g. it is not running,
+    or on a platform without Unix domain sockets,
+    it falls back to using the wrapped persistence as usual.
+    """
+
+    # It may change, when the wrapped persistence falls back to non-atomic writes
+    is_atomic = property(lambda self: self._persistence.is_atomic)
+
+    def __init__(self, persistence, address=None):
+        """
+        :param persistence: A persistence instance, such as ``FilePersistence``.
+        :param str address:
+            Optional. The path of the socket. Defaults to the same as the daemon's.
+        """
+        self._persistence = persistence
+        self.is_encrypted = persistence.is_encrypted
+        self._address = address or _default_address(persistence.get_location())
+        self._socket = None
+        self._reader = None
+        self._lock = threading.Lock()  # One request at a time on a connection
+
+    def _connect(self):
+        connection = socket.socket(socket.AF_UNIX)
+        try:
+            connection.connect(self._address)
+        except OSError:
+            connection.close()
+            raise
+        self._socket, self._reader = connection, connection.makefile("rb")
+
+    def _disconnect(self):
+        if self._socket:
+            self._reader.close()
+            self._socket.close()
+        self._socket = self._reader = None
+
+    def _call(self, op, **params):
+        # Return (True, result), or (False, None) when the daemon is unreachable
+        if not hasattr(socket, "AF_UNIX"):
+            return False, None
+        request = (json.dumps(dict(params, op=op)) + "\n").encode("utf-8")
+        with self._lock:
+            for _ in range(2):  # Reconnect once, in case the daemon was restarted
+                try:
+                    if self._socket is None:
+                        self._connect()
+                    self._socket.sendall(request)
+                    line = self._reader.readline()
+                    if not line:
+                        raise ConnectionError("Daemon closed the connection")
+                    break
+                except OSError:
+                    self._disconnect()
+            else:
+                logger.debug("Daemon at %s is unreachable", self._address)
+                return False, None
+        response = json.loads(line)
+        if "error" in response:
+            raise _rebuild_error(response)
+        return True, response["result"]
+
+    def remote_search(self, credential_type, **kwargs):
+        """Return (True, a list of matching entries), or (False, None)"""
+        return self._call("search", credential_type=credential_type, kwargs=kwargs)
+
+    def remote_get(self, credential_type, key):
+        """Return (True, the entry or None), or (False, None)"""
+        return self._call("get", credential_type=credential_type, key=key)
+
+    def remote_commit(self, changes):
+        """Return (True, None) after committing a list of
+        (credential_type, old_entry, new_key_value_pairs), or (False, None)"""
+        return self._call("commit", changes=changes)
+
+    def close(self):
+        """Close the connection to the daemon, if any"""
+        with self._lock:
+            self._disconnect()
+
+    def save(self, content):
+        # type: (str) -> None
+        self._persistence.save(content)
+
+    def load(self):
+        # type: () -> str
+        return self._persistence.load()
+
+    def time_last_modified(self):
+        return self._persistence.time_last_modified()
+
+    def fingerprint(self):
+        return self._persistence.fingerprint()
+
+    def get_location(self):
+        return self._persistence.get_location()
@@ -0,0 +1,118 @@
+"""A persistence storing each token cache entry as a file inside a directory."""
+import collections
+import errno
+import json
+import os
+
+from .journal import Journal
+from .persistence import BaseEntryPersistence, FilePersistence, _auto_hash, _mkdir_p
+
+
+_CHANGE_LOG_COMPACTION_THRESHOLD = 1024 * 1024  # Bytes
+
+
+class DirectoryPersistence(BaseEntryPersistence):
+    """A persistence storing each token cache entry as a file inside a directory.
+
+    Each entry is saved into a sibling temp file first, and then renamed,
+    so that a reader would see either the old or the new entry.
+    The changed entries are also logged into a change log,
+    so that :func:`~changed_since` would read only the newly logged changes.
+    The log is replaced by an empty one when it grows too large,
+    after which a reader behind it would reload all entries.
+
+    It is a reference implementation of :class:`BaseEntryPersistence`.
+    """
+    is_atomic = True
+
+    def __init__(self, location):
+        """
+        :param string location: The directory path.
+        """
+        if not location:
+            raise ValueError("Requires a directory path")
+        self._location = os.path.expanduser(location)
+        _mkdir_p(self._location)
+        self._change_log = Journal(os.path.join(self._location, "changes.log"))
+        self._position = None  # Where the change log ended, when we wrote it last time
+
+    def _get_entry_location(self, credential_type, key):
+        return os.path.join(self._location, credential_type, _auto_hash(key) + ".json")
+
+    @staticmethod
+    def _read_entry(location):
+        try:
+            with open(location, "rb") as handle:
+                return json.loads(handle.read())  # It is {"key": ..., "entry": ...}
+        except EnvironmentError as exp:  # EnvironmentError in Py 2.7 works across platform
+            if exp.errno == errno.ENOENT:
+                return None
+            raise
+
+    def _log(self, names):
+        # Log a list of (credential_type, key), and return the new version
+        _, position = self._change_log.read(self._position)  # Others may have logged
+        if position[0] is None:  # The change log does not exist yet
+            position = self._change_log.reset()
+        if names:
+            position = self._change_log.append([
+                {"credential_type": credential_type, "key": key}
+                for credential_type, key in names], position)
+        if position[1] > _CHANGE_LOG_COMPACTION_THRESHOLD:
+            position = self._change_log.reset()
+        self._position = position
+        return position
+
+    def get_entry(self, credential_type, key):
+        found = self._read_entry(self._get_entry_location(credential_type, key))
+        return found["entry"] if found else None
+
+    def put_entries(self, entries):
+        for credential_type, key, entry in entries:
+            FilePersistence(
+                self._get_entry_location(credential_type, key), atomic=True,
+                ).save(json.dumps({"key": key, "entry": entry}))
+        return self._log([(credential_type, key) for credential_type, key, _ in entries])
+
+    def delete_entries(self, names):
+        for credential_type, key in names:
+            try:
+                os.remove(self._get_entry_location(credential_type, key))
+            except EnvironmentError as exp:  # EnvironmentError in Py 2.7 works across platform
+                if exp.errno != errno.ENOENT:
+                    raise
+        return self._log(names)
+
+    def changed_since(self, version):
+        # The log is read before the entries, so a concurrent write
+        # would at worst be reported again next time, but never missed.
+        records, position = self._change_log.read(version)
+        if version is None:
+            changes = []
+            for credential_type in os.listdir(self._location):
+                directory = os.path.join(self._location, credential_type)
+                if not os.path.isdir(directory):
+                    continue
+                for filename in os.listdir(directory):
+                    if filename.endswith(".json"):
+                        found = self._read_entry(os.path.join(directory, filename))
+                        if found:
+                            changes.append((credential_type, found["key"], found["entry"]))
+            return position, changes
+        if position[0] != version[0]:  # The log has been replaced
+            return position, None
+        names = list(collections.OrderedDict.fromkeys(  # Deduplicated, in order
+            (record["credential_type"], record["key"]) for record in records))
+        return position, [
+            (credential_type, key, self.get_entry(credential_type, key))
+            for credential_type, key in names]
+
+    def time_last_modified(self):
+        return FilePersistence(self._change_log.get_location()).time_last_modified()
+
+    def fingerprint(self):
+        """A fingerprint of the change log, which grows with each write"""
+        return FilePersistence(self._change_log.get_location()).fingerprint()
+
+    def get_location(self):
+        return self._location
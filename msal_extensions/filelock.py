@@ -4,44 +4,300 @@ import sys
 import errno
 import time
 import logging
+import socket
+import threading
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, where waiters will just poll
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:  # Only available on Windows
+    msvcrt = None
+
+
+from .lock_policy import LockPolicy
 
 
 logger = logging.getLogger(__name__)
 
 
+def _is_contended(ex):
+    return ex.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK)
+
+
+_pending_releases = {}  # Maps (st_dev, st_ino) of a lock file to an Event
+_pending_releases_lock = threading.Lock()
+
+
+def _wait_in_helper(handle, operation):
+    # type: (int, int) -> threading.Event
+    """Return an Event which will be set once a blocking flock() on the file returns.
+
+    At most one helper thread per lock file is pending in this process.
+    Later waiters reuse its Event, rather than each leaving behind
+    yet another blocked thread and dup()-ed handle when they time out.
+    """
+    stat = os.fstat(handle)
+    key = (stat.st_dev, stat.st_ino)
+    with _pending_releases_lock:
+        released = _pending_releases.get(key)
+        if released is not None:
+            return released
+        released = _pending_releases[key] = threading.Event()
+    helper_handle = os.dup(handle)
+
+    def wait():
+        try:
+            fcntl.flock(helper_handle, operation)  # Blocks until holder releases it
+        finally:
+            os.close(helper_handle)
+            with _pending_releases_lock:
+                del _pending_releases[key]
+            released.set()
+    thread = threading.Thread(target=wait)
+    thread.daemon = True
+    thread.start()
+    return released
+
+
+def _flock(handle, operation, timeout):
+    # type: (int, int, float) -> bool
+    """flock() a file descriptor, waiting for at most timeout seconds.
+
+    The waiting happens in kernel, so that we wake up right after the release,
+    rather than at the next tick of a polling interval.
+    Since flock() offers no timeout, the blocking call is made in a helper thread,
+    on a dup() of the handle which shares a same lock.
+    If we time out first, the helper would finish on its own after the release,
+    and then its lock would go away as soon as the caller also closes the handle.
+    Meanwhile, other waiters on the same file wait for that helper,
+    and then retry on their own handles.
+
+    :return: Whether the lock is acquired. Caller shall close the handle otherwise.
+    """
+    current_time = getattr(time, "monotonic", time.time)
+    timeout_end = current_time() + timeout
+    while True:
+        try:
+            # Also succeeds when our own helper has already locked this handle
+            fcntl.flock(handle, operation | fcntl.LOCK_NB)
+            return True
+        except OSError as ex:  # pylint: disable=invalid-name
+            if not _is_contended(ex):
+                raise
+        remaining = timeout_end - current_time()
+        if remaining <= 0 or not _wait_in_helper(handle, operation).wait(remaining):
+            return False
+
+
+def _wait_for_release(lockfile_path, timeout):
+    # type: (str, float) -> bool
+    """Block until the holder of the lock file releases its flock() on it.
+
+    :return:
+        True if the lock file is released or gone, so caller shall retry right away.
+        False on timeout, or when there is no flock() holder to wait for,
+        or when this is unsupported on current platform.
+        Caller shall then fall back to polling.
+    """
+    if fcntl is None:
+        return False
+    try:
+        handle = os.open(lockfile_path, os.O_RDONLY)
+    except OSError as ex:  # pylint: disable=invalid-name
+        return ex.errno == errno.ENOENT  # Holder has just removed it
+    try:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            return False  # Nobody holds a flock(), perhaps a holder of an older version
+        except OSError as ex:  # pylint: disable=invalid-name
+            if not _is_contended(ex):
+                return False
+        return _flock(handle, fcntl.LOCK_SH, timeout)
+    finally:
+        os.close(handle)  # This also releases our own flock()
+
+
+def _lock_file_content():
+    # type: () -> bytes
+    """The holder's pid and name, plus a hostname line telling where the pid lives"""
+    return '{} {}\n{}'.format(  # pylint: disable=consider-using-f-string
+        os.getpid(), sys.argv[0], socket.gethostname()).encode('utf-8')
+
+
+def _is_alive(pid):
+    # type: (int) -> bool
+    """Whether a process is alive on current host. Assume it is, when unsure."""
+    if pid == os.getpid():
+        return True
+    if sys.platform.startswith('win'):
+        import ctypes  # pylint: disable=import-outside-toplevel
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return kernel32.GetLastError() != 87  # ERROR_INVALID_PARAMETER means no such pid
+        try:
+            exit_code = ctypes.c_ulong()
+            if kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+                return exit_code.value == 259  # STILL_ACTIVE
+            return True
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)  # Signal 0 only checks the existence of the process
+    except ProcessLookupError:
+        return False
+    except OSError:  # E.g. PermissionError, which means it exists
+        pass
+    return True
+
+
+def _is_stale(content):
+    # type: (bytes) -> Optional[int]
+    """Return the pid of a holder which died on current host, or None"""
+    lines = content.decode('utf-8', 'replace').splitlines()
+    try:
+        pid = int(lines[0].split(' ', 1)[0])
+    except (IndexError, ValueError):  # E.g. an empty file whose holder is still writing
+        return None
+    if len(lines) < 2 or lines[1] != socket.gethostname():
+        return None  # Written by an older version, or by a process on another host
+    return None if _is_alive(pid) else pid
+
+
+def _is_same_file(handle, path):
+    # type: (int, str) -> bool
+    """Whether the path still refers to the file opened as handle"""
+    opened = os.fstat(handle)
+    try:
+        current = os.stat(path)
+    except OSError:
+        return False
+    return (opened.st_dev, opened.st_ino) == (current.st_dev, current.st_ino)
+
+
+def _stale_holder(handle, lockfile_path):
+    # type: (int, str) -> Optional[int]
+    """Return the pid of a dead holder of the opened lock file, or None.
+
+    On platforms supporting ``flock()``, a pid is returned only when we flock()
+    the file, and the path still refers to it, i.e. it has not been broken
+    and then re-created by another process.
+    """
+    if fcntl:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:  # Its holder is alive, or someone else is breaking it
+            return None
+    pid = _is_stale(os.read(handle, 64 * 1024))
+    if pid is not None and fcntl and not _is_same_file(handle, lockfile_path):
+        return None
+    return pid
+
+
+def _break_stale_lock(lockfile_path):
+    # type: (str) -> bool
+    """Remove the lock file if its holder has died without removing it.
+
+    On platforms supporting ``flock()``, the decision is made while we hold
+    a flock() on the file, which a live holder would be holding instead,
+    and which also keeps other waiters from breaking a same lock at the same time.
+    We then make sure the path still refers to that file before removing it,
+    so that we never remove a lock file newly created by another process.
+
+    :return: True if the lock file is removed or gone, so caller shall retry right away.
+    """
+    try:
+        handle = os.open(lockfile_path, os.O_RDONLY)
+    except OSError as ex:  # pylint: disable=invalid-name
+        return ex.errno == errno.ENOENT
+    pid = None
+    try:
+        pid = _stale_holder(handle, lockfile_path)
+        if pid is not None and not fcntl:
+            # A file can not be removed while it is open on Windows.
+            # Closing it opens a small window for another breaker to race with us,
+            # which we narrow down by checking the content again right before removal.
+            os.close(handle)
+            handle = None
+            with open(lockfile_path, 'rb') as lock_file:
+                if _is_stale(lock_file.read()) != pid:
+                    pid = None
+        if pid is not None:
+            os.remove(lockfile_path)
+    except OSError:  # Let caller wait as usual
+        logger.debug("Unable to break stale lock file %s", lockfile_path, exc_info=True)
+        pid = None
+    finally:
+        if handle is not None:
+            os.close(handle)
+    if pid is not None:
+        logger.warning(
+            "Removed stale lock file %s, left behind by process %d which no longer exists",
+            lockfile_path, pid)
+    return pid is not None
+
+
 class LockError(RuntimeError):
     """It will be raised when unable to obtain a lock"""
 
 
 class CrossPlatLock(object):
-    """This implementation relies only on ``open(..., 'x')``"""
-    def __init__(self, lockfile_path):
+    """This implementation relies only on ``open(..., 'x')``.
+
+    On platforms supporting ``fcntl.flock()``, the holder also flock() the file,
+    so that waiters can be woken up as soon as it is released.
+    """
+    def __init__(self, lockfile_path, policy=None):
+        """
+        :param str lockfile_path: The path of the lock file.
+        :param LockPolicy policy: Defines how to wait for other holders.
+        """
         self._lockpath = lockfile_path
+        self._policy = policy or LockPolicy()
+        self._lock_file = None
+        self._acquired_at = None
 
     def __enter__(self):
-        self._create_lock_file('{} {}'.format(
-            os.getpid(),
-            sys.argv[0],
-            ).encode('utf-8'))  # pylint: disable=consider-using-f-string
+        self._create_lock_file(_lock_file_content())
+        self._acquired_at = time.monotonic()
         return self
 
     def _create_lock_file(self, content):
-        timeout = 5
-        check_interval = 0.25
+        timeout = self._policy.timeout
         current_time = getattr(time, "monotonic", time.time)
         timeout_end = current_time() + timeout
-        while timeout_end > current_time():
+        attempt = 0
+        blocker_modified_time = None
+        while True:
             try:
-                with open(self._lockpath, 'xb') as lock_file:  # pylint: disable=unspecified-encoding
-                    lock_file.write(content)
-                return None  # Happy path
+                lock_file = open(self._lockpath, 'xb')  # pylint: disable=consider-using-with
             except ValueError:  # This needs to be the first clause, for Python 2 to hit it
                 raise LockError("Python 2 does not support atomic creation of file")
             except FileExistsError:  # Only Python 3 will reach this clause
-                logger.debug(
-                    "Process %d found existing lock file, will retry after %f second",
-                    os.getpid(), check_interval)
-                time.sleep(check_interval)
+                if _break_stale_lock(self._lockpath):
+                    continue
+                if timeout_end <= current_time():
+                    break
+                if not _wait_for_release(self._lockpath, timeout_end - current_time()):
+                    logger.debug(
+                        "Process %d found existing lock file, will retry later",
+                        os.getpid())
+                    blocker_modified_time = self._policy.sleep(
+                        attempt, self._lockpath, timeout_end)
+                    attempt += 1
+            else:
+                if fcntl:  # Keep it open and flock()-ed, for waiters to block on
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                    lock_file.write(content)
+                    lock_file.flush()
+                    self._lock_file = lock_file
+                else:
+                    with lock_file:
+                        lock_file.write(content)
+                self._policy.record_acquisition(blocker_modified_time)
+                return None  # Happy path
         raise LockError(
             "Unable to obtain lock, despite trying for {} second(s). "
             "You may want to manually remove the stale lock file {}".format(
@@ -50,6 +306,7 @@ class CrossPlatLock(object):
             ))
 
     def __exit__(self, *args):
+        self._policy.record_hold_time(time.monotonic() - self._acquired_at)
         try:
             os.remove(self._lockpath)
         except OSError as ex:  # pylint: disable=invalid-name
@@ -59,4 +316,81 @@ class CrossPlatLock(object):
                 logger.debug("Unable to remove lock file")
             else:
                 raise
+        finally:
+            if self._lock_file:
+                # Release the flock() after removal, so that the waken-up waiters
+                # would be able to create a new lock file right away
+                self._lock_file.close()
+                self._lock_file = None
+
 
+
+class CrossPlatReadWriteLock(object):
+    """A reader-writer lock, allowing either many readers or one writer at a time.
+
+    It is based on ``flock()`` of a lock file which is never removed,
+    therefore it shall use a different path than a :class:`CrossPlatLock`.
+    On Windows, this pure-Python fallback can only offer exclusive locks,
+    so the readers would be serialized, too.
+    """
+    def __init__(self, lockfile_path, shared=False, policy=None):
+        """
+        :param str lockfile_path: The path of the lock file.
+        :param bool shared: True for a reader, False for a writer.
+        :param LockPolicy policy: Defines how to wait for other holders.
+        """
+        self._lockpath = lockfile_path
+        self._shared = shared
+        self._policy = policy or LockPolicy()
+        self._lock_file = None
+
+    def _try_to_lock(self, lock_file):
+        # Only used on platforms without fcntl.flock()
+        try:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def _unlock(self, lock_file):
+        # Only used on platforms without fcntl.flock()
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def __enter__(self):
+        timeout = self._policy.timeout
+        current_time = getattr(time, "monotonic", time.time)
+        timeout_end = current_time() + timeout
+        lock_file = open(self._lockpath, 'ab')  # pylint: disable=consider-using-with
+        if fcntl:
+            acquired = _flock(
+                lock_file.fileno(),
+                fcntl.LOCK_SH if self._shared else fcntl.LOCK_EX,
+                timeout)
+        else:
+            acquired = self._try_to_lock(lock_file)
+            attempt = 0
+            while not acquired and timeout_end > current_time():
+                self._policy.sleep(
+                    attempt, self._lockpath, timeout_end)
+                attempt += 1
+                acquired = self._try_to_lock(lock_file)
+        if not acquired:
+            lock_file.close()
+            raise self._timeout_error(timeout)
+        self._lock_file = lock_file
+        return self
+
+    def _timeout_error(self, timeout):
+        return LockError(
+            "Unable to obtain {} lock {}, despite trying for {} second(s)".format(
+                "shared" if self._shared else "exclusive", self._lockpath, timeout))
+
+    def __exit__(self, *args):
+        try:
+            if not fcntl:
+                self._unlock(self._lock_file)
+        finally:
+            self._lock_file.close()  # This also releases flock()
+            self._lock_file = None
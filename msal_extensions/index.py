@@ -0,0 +1,69 @@
+"""Hash indexes of token cache entries, on the fields commonly used in queries.
+
+An index maps each (credential_type, field, value) to the keys of the entries
+having that value, so that a query can be narrowed down to its candidates
+rather than scanning every entry of a credential type.
+The candidates still need to be matched against the query as usual.
+
+The index itself does not do any locking. Callers are expected to hold
+the same in-process lock which also protects the cache it indexes.
+"""
+
+
+class SecondaryIndex(object):
+    """Indexes a cache, which is in the same format as the one in msal.TokenCache"""
+    fields = ("home_account_id", "client_id", "environment", "realm")
+
+    def __init__(self, cache):
+        self._postings = {}  # Maps (credential_type, field, value) to a set of keys
+        self._indexed = {}  # Maps (credential_type, key) to its posting names
+        for credential_type, entries in cache.items():
+            for key, entry in entries.items():
+                self._add(credential_type, key, entry)
+
+    def _add(self, credential_type, key, entry):
+        names = [
+            (credential_type, field, entry[field]) for field in self.fields
+            if field in entry and _is_hashable(entry[field])]
+        names.extend(
+            (credential_type, "target", scope)
+            for scope in set((entry.get("target") or "").split()))
+        for name in names:
+            self._postings.setdefault(name, set()).add(key)
+        self._indexed[(credential_type, key)] = names
+
+    def _remove(self, credential_type, key):
+        for name in self._indexed.pop((credential_type, key), []):
+            keys = self._postings[name]
+            keys.discard(key)
+            if not keys:
+                del self._postings[name]
+
+    def update(self, credential_type, key, entry):
+        """Reindex an entry, which is None if it has been removed"""
+        self._remove(credential_type, key)
+        if entry is not None:
+            self._add(credential_type, key, entry)
+
+    def lookup(self, credential_type, target=None, query=None):
+        """Return the keys of the candidate entries,
+        or None if the query has no indexed field to narrow it down."""
+        names = [
+            (credential_type, field, value.lower()  # Same as what msal does
+                if field == "environment" and isinstance(value, str) else value)
+            for field, value in (query or {}).items()
+            if field in self.fields and _is_hashable(value)]
+        names.extend((credential_type, "target", scope) for scope in set(target or []))
+        if not names:
+            return None
+        # Start from the smallest posting, for a cheaper intersection
+        postings = sorted((self._postings.get(name, set()) for name in names), key=len)
+        return postings[0].intersection(*postings[1:])
+
+
+def _is_hashable(value):
+    try:
+        hash(value)
+        return True
+    except TypeError:
+        return False
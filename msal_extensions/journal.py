@@ -0,0 +1,99 @@
+"""An append-only journal of token cache changes, stored next to a snapshot.
+
+Each journal starts with a header line containing a random generation id,
+followed by one JSON line per change. A reader remembers a position,
+which is a (generation, offset) tuple, so that it can later read only the
+records appended after that position. When the journal is compacted,
+it is replaced by a new empty journal with a new generation,
+which tells readers that their position is no longer valid.
+
+The journal itself does not do any locking. Writers are expected to hold
+the same cross-process lock which also protects the snapshot.
+"""
+import errno
+import json
+import os
+import uuid
+
+
+class Journal(object):
+    """A journal file. Records are json-serializable dicts."""
+
+    def __init__(self, location):
+        self._location = location
+
+    def get_location(self):
+        """Return the file path of this journal"""
+        return self._location
+
+    def read(self, position=None):
+        """Read records appended after position.
+
+        :param position:
+            A position previously returned by this object, or None.
+            If the journal has been replaced since then,
+            records will be read from the beginning of the current journal.
+        :return: A tuple of (records, new_position).
+            The generation inside new_position is None if journal does not exist.
+        """
+        try:
+            handle = open(self._location, "rb")
+        except EnvironmentError as exp:  # EnvironmentError in Py 2.7 works across platform
+            if exp.errno == errno.ENOENT:
+                return [], (None, 0)
+            raise
+        with handle:
+            header = handle.readline()
+            generation = json.loads(header.decode("utf-8"))["generation"]
+            if position and position[0] == generation:
+                handle.seek(position[1])
+            start = handle.tell()
+            data = handle.read()
+        end = data.rfind(b"\n") + 1  # Ignore an incomplete record still being written
+        records, offset = [], 0
+        for line in data[:end].splitlines(True):
+            try:
+                records.append(json.loads(line.decode("utf-8")))
+            except ValueError:  # Torn by a crashed writer. Next append() would discard it.
+                break
+            offset += len(line)
+        return records, (generation, start + offset)
+
+    def append(self, records, position):
+        """Append records to the end of current journal, and return new position.
+
+        :param position: The current end of the journal, i.e. a position
+            returned by a previous :func:`~read`, :func:`~append` or :func:`~reset`
+            while the caller has been holding the lock.
+            Anything after it, e.g. a record torn by a writer which crashed
+            in the middle of appending it, is discarded.
+        """
+        data = "".join(
+            json.dumps(record, separators=(",", ":")) + "\n" for record in records
+            ).encode("utf-8")
+        handle = os.open(self._location, os.O_WRONLY, 0o600)
+        try:
+            os.ftruncate(handle, position[1])
+            os.lseek(handle, position[1], os.SEEK_SET)
+            written = 0
+            while written < len(data):
+                written += os.write(handle, data[written:])
+        finally:
+            os.close(handle)
+        return (position[0], position[1] + len(data))
+
+    def reset(self):
+        """Replace the journal with an empty one of a new generation.
+
+        :return: The position at the beginning of the new journal.
+        """
+        generation = uuid.uuid4().hex
+        header = (json.dumps({"generation": generation}) + "\n").encode("utf-8")
+        temp_location = "{}.{}.tmp".format(self._location, generation)  # pylint: disable=consider-using-f-string
+        handle = os.open(temp_location, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            os.write(handle, header)
+        finally:
+            os.close(handle)
+        os.replace(temp_location, self._location)
+        return (generation, len(header))
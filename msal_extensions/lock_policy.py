@@ -0,0 +1,126 @@
+"""Defines how a cross-process lock waits when it is held by another process."""
+import os
+import random
+import time
+
+
+# Its attributes are the settings documented in __init__(), plus what adaptive mode learnt
+class LockPolicy(object):  # pylint: disable=too-many-instance-attributes
+    """How long and how often a lock would retry when it is held by others.
+
+    The default policy matches the historical behavior,
+    i.e. retrying every 0.25 second for up to 5 seconds.
+    Note that, on platforms supporting ``flock()``, the waiting is mostly done
+    by blocking in kernel, and the intervals defined here are only used
+    when the holder of a lock file can not be waited that way.
+
+    A same policy instance can be shared by multiple locks.
+    In adaptive mode, the policy learns from the hold times observed by all of them.
+
+    The locks of this package call its methods. A custom lock may call them, too.
+    """
+    _smoothing_factor = 0.2  # Weight of the latest sample in the moving average
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        timeout=5,
+        interval=0.25,
+        backoff=1,
+        max_interval=None,
+        jitter=0,
+        adaptive=False,
+        raise_on_timeout=False,
+    ):
+        """
+        :param float timeout:
+            The total seconds to wait for a lock, before giving up.
+        :param float interval:
+            The seconds to wait before the first retry.
+        :param float backoff:
+            Each subsequent interval will be multiplied by this factor.
+            The default value 1 means a constant interval,
+            while 2 means an exponential backoff.
+        :param float max_interval:
+            The upper bound of an interval. Defaults to the timeout.
+        :param float jitter:
+            A ratio between 0 and 1. Each interval will be randomly shortened
+            or prolonged by up to this ratio,
+            so that multiple waiters would not retry at the same pace.
+        :param bool adaptive:
+            When True, the interval will be tuned by the average hold time
+            previously observed, and by how long the current holder has held
+            the lock, which is the age of its lock file.
+            A waiter will then sleep till the moment the current holder
+            is expected to release the lock.
+            The hold times are kept in memory only when this is True.
+        :param bool raise_on_timeout:
+            The portalocker-based lock would, by default, log a warning and proceed
+            after a timeout. Set this to True to make it raise ``LockError`` instead.
+            The fallback lock always raises ``LockError`` after a timeout.
+        """
+        if not 0 <= jitter <= 1:
+            raise ValueError("jitter shall be between 0 and 1")
+        self.timeout = timeout
+        self.interval = interval
+        self.backoff = backoff
+        self.max_interval = timeout if max_interval is None else max_interval
+        self.jitter = jitter
+        self.adaptive = adaptive
+        self.raise_on_timeout = raise_on_timeout
+        self._average_hold_time = None  # Only tracked in adaptive mode
+
+    def get_interval(self, attempt, lock_file_age):
+        # type: (int, Optional[float]) -> float
+        """Return the seconds to wait before the next attempt, which is 0-based"""
+        interval = None
+        if self.adaptive and self._average_hold_time is not None:
+            if lock_file_age is None:  # The lock file is gone, no need to wait
+                return 0
+            if lock_file_age < self._average_hold_time:  # Otherwise holder is overdue
+                interval = self._average_hold_time - lock_file_age
+        if interval is None:
+            interval = self.interval * self.backoff ** attempt
+        if self.jitter:
+            interval *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return min(interval, self.max_interval)
+
+    def next_interval(self, attempt, lockfile_path):
+        # type: (int, str) -> Tuple[float, Optional[float]]
+        """Return the seconds to wait before next attempt,
+        and the modified time of the lock file being waited, if any.
+
+        The lock file is only looked at in adaptive mode.
+        """
+        if not self.adaptive:
+            return self.get_interval(attempt, None), None
+        try:
+            modified_time = os.path.getmtime(lockfile_path)
+        except OSError:
+            modified_time = None
+        return self.get_interval(attempt, None if modified_time is None else max(
+            time.time() - modified_time, 0)), modified_time
+
+    def sleep(self, attempt, lockfile_path, deadline):
+        # type: (int, str, float) -> Optional[float]
+        """Sleep before next attempt, but not beyond the monotonic deadline.
+
+        :return: The modified time of the lock file being waited, if any.
+        """
+        interval, modified_time = self.next_interval(attempt, lockfile_path)
+        time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+        return modified_time
+
+    def record_hold_time(self, seconds):
+        """Holders report how long they held a lock, for the adaptive mode"""
+        if not self.adaptive:
+            return
+        self._average_hold_time = seconds if self._average_hold_time is None else (
+            self._smoothing_factor * seconds
+            + (1 - self._smoothing_factor) * self._average_hold_time)
+
+    def record_acquisition(self, blocker_modified_time):
+        """Waiters report the modified time of the lock file they waited for,
+        right after they acquire the lock, which approximates its hold time.
+        This way we learn the hold times of other processes, too."""
+        if self.adaptive and blocker_modified_time is not None:
+            self.record_hold_time(max(time.time() - blocker_modified_time, 0))
@@ -10,8 +10,14 @@ import abc
 import os
 import errno
 import hashlib
+import io
+import json
+import locale
+import importlib
 import logging
+import mmap
 import sys
+import tempfile
 try:
     from pathlib import Path  # Built-in in Python 3
 except ImportError:
@@ -83,11 +89,21 @@ class PersistenceDecryptionError(PersistenceError):
     """This could be raised by persistence.load()"""
 
 
-def build_encrypted_persistence(location):
+def build_encrypted_persistence(location, **symmetric_key):
     """Build a suitable encrypted persistence instance based your current OS.
 
     If you do not need encryption, then simply use ``FilePersistence`` constructor.
+
+    :param symmetric_key:
+        Optional. Any of ``key``, ``key_file``, ``key_fd`` or ``key_env``,
+        and optionally its ``key_encoding``.
+        When provided, a :class:`FilePersistenceWithSymmetricKey` is built
+        instead, on any platform. It is useful on a headless machine.
     """
+    if symmetric_key:
+        from .symmetric_persistence import (  # pylint: disable=import-outside-toplevel,cyclic-import
+            FilePersistenceWithSymmetricKey)  # It imports this module
+        return FilePersistenceWithSymmetricKey(location, **symmetric_key)
     # Does not (yet?) support fallback_to_plaintext flag,
     # because the persistence on Windows and macOS do not support built-in trial_run().
     if sys.platform.startswith('win'):
@@ -103,6 +119,7 @@ class BasePersistence(ABC):
     """An abstract persistence defining the common interface of this family"""
 
     is_encrypted = False  # Default to False. To be overridden by sub-classes.
+    is_atomic = False  # Whether a load() would never observe a partially saved content
 
     @abc.abstractmethod
     def save(self, content):
@@ -132,33 +149,246 @@ class BasePersistence(ABC):
         """Return the file path which this persistence stores (meta)data into"""
         raise NotImplementedError
 
+    def fingerprint(self):
+        """Return an opaque value which changes whenever this persistence changes.
+
+        Callers shall only compare two fingerprints for equality.
+        The default implementation falls back to :func:`~time_last_modified`,
+        sub-classes are encouraged to provide something of higher resolution.
+
+        Could raise PersistenceNotFound if no save() was called before.
+        """
+        return self.time_last_modified()
+
+class BaseEntryPersistence(BasePersistence):
+    """An abstract persistence which also stores and tracks each entry of a token cache.
+
+    :class:`PersistedTokenCache` would then write only the changed entries,
+    and reload only the entries changed since its last reload,
+    rather than the whole content. These methods shall be called
+    while holding the lock, i.e. the lock file or its :func:`~transaction`.
+
+    Its save() and load() still work with the whole content,
+    which shall be a JSON object of credential types,
+    each of which is a JSON object of entries.
+
+    A version is an opaque value returned by these methods,
+    which can only be passed back into :func:`~changed_since`.
+    """
+
+    @abc.abstractmethod
+    def get_entry(self, credential_type, key):
+        # type: (str, str) -> Optional[dict]
+        """Return the entry, or None if it does not exist"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def put_entries(self, entries):
+        """Add or replace a list of (credential_type, key, entry), and return the new version"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_entries(self, names):
+        """Delete a list of (credential_type, key), and return the new version"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def changed_since(self, version):
+        """Return (new_version, changes) since a version.
+
+        :param version: A version returned by a previous call, or None.
+        :return: A tuple of (new_version, changes).
+            The changes is a list of (credential_type, key, entry),
+            whose entry is None when it has been deleted.
+            When the version is None, the changes are all the existing entries.
+            When the changes since the version are no longer tracked,
+            the changes is None, and the caller shall start over by
+            ``changed_since(None)``.
+        """
+        raise NotImplementedError
+
+    def save(self, content):
+        # type: (str) -> None
+        """Save the content into this persistence, by writing only the changed entries"""
+        entries = {
+            (credential_type, key): entry
+            for credential_type, section in (json.loads(content) if content else {}).items()
+            for key, entry in section.items()}
+        _, existing = self.changed_since(None)
+        existing = {(credential_type, key): entry for credential_type, key, entry in existing}
+        self.put_entries([
+            name + (entry,) for name, entry in entries.items()
+            if existing.get(name) != entry])
+        self.delete_entries([name for name in existing if name not in entries])
+
+    def load(self):
+        # type: () -> str
+        """Load all the entries, as the whole content"""
+        self.fingerprint()  # Raises PersistenceNotFound if no save() was called before
+        cache = {}
+        for credential_type, key, entry in self.changed_since(None)[1]:
+            cache.setdefault(credential_type, {})[key] = entry
+        return json.dumps(cache, indent=4)
+
+
+# An uncompressed content is saved and loaded in this encoding,
+# which is the same as what open(..., 'w') has been using by default
+_TEXT_ENCODING = locale.getpreferredencoding(False)
+
+
+def _encoding_of(mode):
+    return None if "b" in mode else _TEXT_ENCODING
+
 
 def _open(location):
     return os.open(location, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
         # The 600 seems no-op on NTFS/Windows, and that is fine
 
 
+# Names of the compression modules. They are imported only when used,
+# because lzma is optional in CPython, and absent from some builds.
+_COMPRESSORS = ("zlib", "lzma")
+# A JSON document never starts with a NUL, so legacy content won't be mistaken
+_COMPRESSION_MAGIC = b"\x00msal-extensions-compressed:"
+
+
+def _validate_compression(compression):
+    if compression is not None:
+        if compression not in _COMPRESSORS:
+            raise ValueError("compression shall be one of {}, or None".format(
+                sorted(_COMPRESSORS)))  # pylint: disable=consider-using-f-string
+        importlib.import_module(compression)  # Fail early, when it is unavailable
+    return compression
+
+
+def _compress(content, compression):
+    # type: (str, str) -> bytes
+    """Compress content, prefixed by a header naming the algorithm"""
+    return b"".join([
+        _COMPRESSION_MAGIC, compression.encode("ascii"), b"\n",
+        importlib.import_module(compression).compress(content.encode("utf-8")),
+        ])
+
+
+def _is_compressed(data):
+    return data[:len(_COMPRESSION_MAGIC)] == _COMPRESSION_MAGIC
+
+
+def _decompress(data):
+    # type: (bytes) -> bytes
+    """Decompress data which starts with the header written by _compress()"""
+    header_end = data.find(b"\n", len(_COMPRESSION_MAGIC))
+    compression = bytes(data[len(_COMPRESSION_MAGIC):header_end]).decode("ascii")
+    if header_end < 0 or compression not in _COMPRESSORS:
+        raise ValueError("Unknown compression: {}".format(compression))  # pylint: disable=consider-using-f-string
+    return importlib.import_module(compression).decompress(data[header_end + 1:])
+
+
+def _read_bytes(location):
+    # type: (str) -> bytes
+    """Read the whole file, or raise PersistenceNotFound when it does not exist"""
+    try:
+        with open(location, 'rb') as handle:
+            return handle.read()
+    except EnvironmentError as exp:  # EnvironmentError in Py 2.7 works across platform
+        if exp.errno == errno.ENOENT:
+            raise PersistenceNotFound(
+                message=(
+                    "Persistence not initialized. "
+                    "You can recover by calling a save() first."),
+                location=location,
+                )
+        raise
+
+
+def _replace(location, data, mode):
+    """Write data into a sibling temp file, and then rename it to location"""
+    directory, filename = os.path.split(location)
+    handle, temp_location = tempfile.mkstemp(  # Also created with 600
+        prefix=filename + ".", suffix=".tmp", dir=directory or None)
+    try:
+        with os.fdopen(handle, mode, encoding=_encoding_of(mode)) as temp_file:
+            temp_file.write(data)
+        os.replace(temp_location, location)
+    except OSError:
+        os.remove(temp_location)
+        raise
+
+
 class FilePersistence(BasePersistence):
     """A generic persistence, storing data in a plain-text file"""
 
-    def __init__(self, location):
+    def __init__(self, location, atomic=False, memory_map=False, compression=None):
+        """
+        :param string location: The file path.
+        :param bool atomic:
+            Opt-in. When True, each save() writes into a sibling temp file first,
+            and then renames it to the file path,
+            so that a concurrent load() will see either the old or the new content,
+            but never a partially written file.
+            On Windows, the rename would fail when other process is reading the file,
+            in which case we fall back to writing the file in place,
+            and ``is_atomic`` becomes False from then on.
+        :param bool memory_map:
+            Opt-in. When True, load() decodes the content straight out of
+            a memory map of the file, rather than reading it into a buffer first,
+            which reduces the peak memory usage of loading a large file.
+            The map is closed before load() returns.
+            It implies ``atomic=True``, because a file truncated in place
+            while being mapped would crash the reader,
+            so all processes writing to this file shall also save atomically.
+        :param str compression:
+            Opt-in. Either "zlib" or "lzma", to save the content compressed.
+            The compressed content starts with a header,
+            so load() detects it automatically, regardless of this setting,
+            and still loads the uncompressed content saved by older versions.
+            All processes sharing a persistence shall be able to load it,
+            i.e. use a version of this package which supports compression.
+        """
         if not location:
             raise ValueError("Requires a file path")
         self._location = os.path.expanduser(location)
+        self._atomic = atomic or memory_map
+        self.is_atomic = self._atomic
+        self._memory_map = memory_map
+        self._compression = _validate_compression(compression)
         _mkdir_p(os.path.dirname(self._location))
 
+    def _write(self, data, mode):
+        if self._atomic:
+            try:
+                _replace(self._location, data, mode)
+                return
+            except PermissionError:  # Presumably a Windows reader is holding the file
+                logger.debug("Unable to replace %s. Write in place instead.", self._location)
+                # A reader could now observe a partial write, so it shall back off
+                self.is_atomic = False
+        with os.fdopen(
+                _open(self._location), mode + '+', encoding=_encoding_of(mode),
+                ) as handle:
+            handle.write(data)
+
     def save(self, content):
         # type: (str) -> None
         """Save the content into this persistence"""
-        with os.fdopen(_open(self._location), 'w+') as handle:
-            handle.write(content)
+        if self._compression:
+            self._write(_compress(content, self._compression), 'wb')
+        else:
+            self._write(content, 'w')
 
     def load(self):
         # type: () -> str
         """Load content from this persistence"""
         try:
-            with open(self._location, 'r') as handle:  # pylint: disable=unspecified-encoding
-                return handle.read()
+            if self._memory_map:
+                with open(self._location, 'rb') as handle:
+                    return self._decode_memory_map(handle)
+            with open(self._location, 'rb') as handle:
+                if _is_compressed(handle.read(len(_COMPRESSION_MAGIC))):
+                    handle.seek(0)
+                    return _decompress(handle.read()).decode("utf-8")
+                handle.seek(0)
+                return io.TextIOWrapper(handle, encoding=_TEXT_ENCODING).read()
         except EnvironmentError as exp:  # EnvironmentError in Py 2.7 works across platform
             if exp.errno == errno.ENOENT:
                 raise PersistenceNotFound(
@@ -169,6 +399,16 @@ class FilePersistence(BasePersistence):
                     )
             raise
 
+    @staticmethod
+    def _decode_memory_map(handle):
+        try:
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # An empty file can not be mapped
+            return ""
+        with mapped:  # Closed right away, so that the file can be replaced on Windows
+            if _is_compressed(mapped):
+                return _decompress(mapped).decode("utf-8")
+            return str(mapped, _TEXT_ENCODING)
 
     def time_last_modified(self):
         try:
@@ -183,6 +423,26 @@ class FilePersistence(BasePersistence):
                     )
             raise
 
+    def fingerprint(self):
+        """A fingerprint based on inode, size and nanosecond-resolution mtime.
+
+        Unlike :func:`~time_last_modified`, this would still change
+        when two writes land in a same tick of a coarse mtime,
+        as long as they differ in size or replace the file.
+        """
+        try:
+            stat = os.stat(self._location)
+        except EnvironmentError as exp:  # EnvironmentError in Py 2.7 works across platform
+            if exp.errno == errno.ENOENT:
+                raise PersistenceNotFound(
+                    message=(
+                        "Persistence not initialized. "
+                        "You can recover by calling a save() first."),
+                    location=self._location,
+                    )
+            raise
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
     def touch(self):
         """To touch this file-based persistence without writing content into it"""
         Path(self._location).touch()  # For os.path.getmtime() to work
@@ -196,24 +456,31 @@ class FilePersistenceWithDataProtection(FilePersistence):
     protected by Win32 encryption APIs on Windows"""
     is_encrypted = True
 
-    def __init__(self, location, entropy=''):
-        """Initialization could fail due to unsatisfied dependency"""
+    def __init__(self, location, entropy='', atomic=False, compression=None):
+        """Initialization could fail due to unsatisfied dependency.
+
+        :param bool atomic: See :func:`persistence.FilePersistence.__init__`
+        :param str compression: See :func:`persistence.FilePersistence.__init__`.
+            The content is compressed before being encrypted,
+            which also makes the encryption faster.
+        """
         # pylint: disable=import-outside-toplevel
         from .windows import WindowsDataProtectionAgent
         self._dp_agent = WindowsDataProtectionAgent(entropy=entropy)
-        super(FilePersistenceWithDataProtection, self).__init__(location)
+        super(FilePersistenceWithDataProtection, self).__init__(
+            location, atomic=atomic, compression=compression)
 
     def save(self, content):
         # type: (str) -> None
         try:
-            data = self._dp_agent.protect(content)
+            data = self._dp_agent.protect(
+                _compress(content, self._compression) if self._compression else content)
         except OSError as exception:
             raise PersistenceEncryptionError(
                 err_no=getattr(exception, "winerror", None),  # Exists in Python 3 on Windows
                 message="Encryption failed: {} Consider disable encryption.".format(exception),
                 )
-        with os.fdopen(_open(self._location), 'wb+') as handle:
-            handle.write(data)
+        self._write(data, 'wb')
 
     def load(self):
         # type: () -> str
@@ -233,7 +500,7 @@ class FilePersistenceWithDataProtection(FilePersistence):
                 "App developer should migrate by calling save(plaintext) first.")
             raise
         try:
-            return self._dp_agent.unprotect(data)
+            data = self._dp_agent.unprotect(data, decode=False)
         except OSError as exception:
             raise PersistenceDecryptionError(
                 err_no=getattr(exception, "winerror", None),  # Exists in Python 3 on Windows
@@ -243,6 +510,7 @@ class FilePersistenceWithDataProtection(FilePersistence):
                     .format(exception),
                 location=self._location,
                 )
+        return (_decompress(data) if _is_compressed(data) else data).decode("utf-8")
 
 
 class KeychainPersistence(BasePersistence):
@@ -290,6 +558,9 @@ class KeychainPersistence(BasePersistence):
     def time_last_modified(self):
         return self._file_persistence.time_last_modified()
 
+    def fingerprint(self):
+        return self._file_persistence.fingerprint()
+
     def get_location(self):
         return self._file_persistence.get_location()
 
@@ -335,9 +606,13 @@ class LibsecretPersistence(BasePersistence):
     def time_last_modified(self):
         return self._file_persistence.time_last_modified()
 
+    def fingerprint(self):
+        return self._file_persistence.fingerprint()
+
     def get_location(self):
         return self._file_persistence.get_location()
 
+
 # We could also have a KeyringPersistence() which can then be used together
 # with a FilePersistence to achieve
 #  https://github.com/AzureAD/microsoft-authentication-extensions-for-python/issues/12
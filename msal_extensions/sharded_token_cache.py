@@ -0,0 +1,110 @@
+"""A token cache partitioned across multiple persistences, each with its own lock."""
+import itertools
+import json
+import zlib
+
+import msal
+
+from .token_cache import PersistedTokenCache
+
+
+def _by_home_account_id(entry):
+    return entry.get("home_account_id")
+
+
+class ShardedPersistedTokenCache(msal.SerializableTokenCache):
+    """A token cache whose entries are partitioned across multiple persistences.
+
+    Each partition, known as a shard, is a :class:`PersistedTokenCache`
+    with its own persistence and its own lock file,
+    so that writes to different shards neither block nor rewrite each other.
+    By default, entries are partitioned by their ``home_account_id``,
+    so that token refreshes of different accounts would proceed in parallel,
+    while :func:`~search` still presents one logical cache. For example::
+
+        cache = ShardedPersistedTokenCache([
+            FilePersistence("token_cache.{}.bin".format(i)) for i in range(8)])
+
+    All processes sharing a set of shards shall use a same list of persistences,
+    in a same order, and a same ``shard_key``.
+
+    Same as :class:`PersistedTokenCache`, :func:`~deserialize` and :func:`~serialize`
+    work on the in-memory snapshot only.
+    """
+    def __init__(self, persistences, shard_key=None, **kwargs):
+        """
+        :param list persistences:
+            A list of persistence instances, such as ``FilePersistence``,
+            one per shard.
+        :param shard_key:
+            Optional. A function which receives an entry, and returns a str
+            which decides its shard, or None to put it into the first shard.
+            It also receives the query of each :func:`~search`,
+            which is then routed to one shard when the returned value is not None,
+            or to all shards otherwise.
+            Therefore, the returned value shall only be derived from the fields
+            which, when present in a query, an entry must equal to match.
+            Defaults to using the ``home_account_id``.
+        :param kwargs:
+            Other parameters to be passed to each :class:`PersistedTokenCache`.
+        """
+        if not persistences:
+            raise ValueError("Requires at least one persistence")
+        self._shards = [PersistedTokenCache(p, **kwargs) for p in persistences]
+        super(ShardedPersistedTokenCache, self).__init__()
+        self._shard_key = shard_key or _by_home_account_id
+        self.is_encrypted = all(p.is_encrypted for p in persistences)
+
+    def _get_shard_index(self, key):
+        # A stable hash, unlike the randomized hash(), so all processes agree
+        return zlib.crc32(str(key).encode("utf-8")) % len(self._shards)
+
+    def _get_shard(self, entry):
+        key = self._shard_key(entry)
+        return self._shards[0 if key is None else self._get_shard_index(key)]
+
+    def modify(self, credential_type, old_entry, new_key_value_pairs=None):
+        self._get_shard(old_entry).modify(
+            credential_type, old_entry, new_key_value_pairs=new_key_value_pairs)
+        self.has_state_changed = True
+
+    def search(self, credential_type, target=None, query=None, **kwargs):  # pylint: disable=arguments-differ
+        key = self._shard_key(query or {})
+        shards = self._shards if key is None else [
+            self._shards[self._get_shard_index(key)]]
+        return itertools.chain.from_iterable(
+            shard.search(credential_type, target=target, query=query, **kwargs)
+            for shard in shards)
+
+    def _get(self, credential_type, key, default=None):
+        # Only the entry knows its shard, but here we have only its key
+        for shard in self._shards:
+            entry = shard._get(credential_type, key)  # pylint: disable=protected-access
+            if entry is not None:
+                return entry
+        return default
+
+    def deserialize(self, state):
+        # type: (Optional[str]) -> None
+        """Distribute the cache state into shards' in-memory snapshots"""
+        partitions = [{} for _ in self._shards]
+        for credential_type, entries in (json.loads(state) if state else {}).items():
+            for key, entry in entries.items():
+                shard_index = self._shards.index(self._get_shard(entry))
+                partitions[shard_index].setdefault(credential_type, {})[key] = entry
+        for shard, partition in zip(self._shards, partitions):
+            with shard._lock:  # pylint: disable=protected-access
+                shard._cache = partition  # pylint: disable=protected-access
+        self.has_state_changed = False
+
+    def serialize(self):
+        # type: () -> str
+        """Serialize the merged in-memory snapshots of all shards"""
+        merged = {}
+        for shard in self._shards:
+            shard._materialize()  # pylint: disable=protected-access
+            with shard._lock:  # pylint: disable=protected-access
+                for credential_type, entries in shard._cache.items():  # pylint: disable=protected-access
+                    merged.setdefault(credential_type, {}).update(entries)
+        self.has_state_changed = False
+        return json.dumps(merged, indent=4)
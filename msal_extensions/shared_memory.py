@@ -0,0 +1,156 @@
+"""A persistence wrapper which also publishes its content into shared memory.
+
+The shared memory is a memory-mapped sidecar file next to the persistence,
+which all processes on a same machine map into their address spaces.
+Its header contains a sequence counter, which a writer increments
+before and after it writes the content (so it is odd during a write),
+and a checksum of the content.
+A reader copies the content out, and then checks that the counter stays
+the same even number and that the checksum matches, otherwise it retries.
+This is known as a seqlock. Readers never block the writer, nor each other,
+and neither a reader nor an unchanged fingerprint() needs any file I/O.
+"""
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from .persistence import BasePersistence
+
+
+_HEADER = struct.Struct("<8sQQII")  # magic, sequence, length, checksum, origin
+_MAGIC = b"MSALSHM1"
+_OVERFLOW = 2 ** 64 - 1  # A length meaning the content is only in the persistence
+_READ_ATTEMPTS = 100
+
+
+def _digest(fingerprint):
+    return zlib.crc32(repr(fingerprint).encode("utf-8"))
+
+
+class SharedMemoryPersistence(BasePersistence):
+    """Wraps a persistence, such as ``FilePersistence``, which remains the
+    durable source of truth, and shares its latest content via memory,
+    so that processes on a same machine would reload it from memory.
+
+    All the processes writing to the persistence shall use this wrapper,
+    because changes made without it are not noticed
+    until it is saved via this wrapper again.
+    Its :func:`~save` shall be called while holding the lock,
+    as :class:`PersistedTokenCache` does.
+
+    The shared memory is not encrypted, so an encrypted persistence is refused.
+    """
+
+    # It may change, when the wrapped persistence falls back to non-atomic writes
+    is_atomic = property(lambda self: self._persistence.is_atomic)
+
+    def __init__(self, persistence, capacity=1024 * 1024):
+        """
+        :param persistence: A persistence instance, such as ``FilePersistence``.
+        :param int capacity:
+            The initial size, in bytes, of the shared memory, which would
+            grow when a larger content is saved.
+            The shared memory is a file named after the persistence plus ``.shm``.
+        """
+        if persistence.is_encrypted:
+            raise ValueError(
+                "Shared memory would store tokens in plaintext, "
+                "therefore it can not be used with an encrypted persistence")
+        self._persistence = persistence
+        self._location = persistence.get_location() + ".shm"
+        self._map = self._open(_HEADER.size + capacity)
+        # The shared memory may be left behind by a previous session,
+        # after which the persistence was changed without this wrapper
+        magic, sequence, _, _, origin = _HEADER.unpack_from(self._map)
+        try:
+            current_origin = _digest(persistence.fingerprint())
+        except IOError:  # E.g. PersistenceNotFound
+            current_origin = None
+        self._stale_sequence = sequence if (
+            magic == _MAGIC and origin != current_origin) else None
+
+    def _open(self, size):
+        handle = os.open(self._location, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(handle).st_size < size:
+                os.ftruncate(handle, size)  # Padded with zeros
+            return mmap.mmap(handle, 0)  # It keeps its own handle of the file
+        finally:
+            os.close(handle)
+
+    def _remap(self, size):
+        new_map = self._open(size)
+        self._map.close()
+        self._map = new_map
+
+    def _read(self):
+        """Return (sequence, content) from the shared memory.
+
+        The sequence is None if nothing has been published,
+        and the content is None if it shall be loaded from the persistence.
+        """
+        for _ in range(_READ_ATTEMPTS):
+            magic, sequence, length, checksum, _ = _HEADER.unpack_from(self._map)
+            if magic != _MAGIC or sequence == self._stale_sequence:
+                return None, None
+            if sequence % 2:  # A write is in progress
+                time.sleep(0)
+                continue
+            if length == _OVERFLOW:
+                return sequence, None
+            if _HEADER.size + length > len(self._map):  # It has grown
+                self._remap(_HEADER.size + length)
+            data = self._map[_HEADER.size:_HEADER.size + length]
+            if (_HEADER.unpack_from(self._map)[1] == sequence
+                    and zlib.crc32(data) == checksum):
+                return sequence, data.decode("utf-8")
+        return None, None  # Presumably a writer crashed in the middle
+
+    def _publish(self, content):
+        data = content.encode("utf-8")
+        magic, sequence, _, _, _ = _HEADER.unpack_from(self._map)
+        if magic != _MAGIC:
+            sequence = 0
+        sequence += sequence % 2  # In case a previous writer crashed in the middle
+        length = len(data)
+        if _HEADER.size + length > len(self._map):
+            try:
+                self._remap(max(_HEADER.size + length, 2 * len(self._map)))
+            except (OSError, ValueError):  # E.g. Windows can not resize a mapped file
+                length = _OVERFLOW
+        origin = _digest(self._persistence.fingerprint())
+        _HEADER.pack_into(self._map, 0, _MAGIC, sequence + 1, 0, 0, 0)
+        if length != _OVERFLOW:
+            self._map[_HEADER.size:_HEADER.size + length] = data
+        _HEADER.pack_into(
+            self._map, 0, _MAGIC, sequence + 2, length,
+            zlib.crc32(data) if length != _OVERFLOW else 0, origin)
+        self._stale_sequence = None
+
+    def save(self, content):
+        # type: (str) -> None
+        """Save the content into the persistence, and then publish it"""
+        self._persistence.save(content)
+        self._publish(content)
+
+    def load(self):
+        # type: () -> str
+        """Load content from shared memory, or from the persistence as a fallback"""
+        _, content = self._read()
+        return self._persistence.load() if content is None else content
+
+    def fingerprint(self):
+        """The sequence number of shared memory, or the persistence's fingerprint
+        when nothing has been published"""
+        magic, sequence, _, _, _ = _HEADER.unpack_from(self._map)
+        if magic != _MAGIC or sequence == self._stale_sequence:
+            return self._persistence.fingerprint()
+        return ("shm", sequence)
+
+    def time_last_modified(self):
+        return self._persistence.time_last_modified()
+
+    def get_location(self):
+        return self._persistence.get_location()
@@ -0,0 +1,192 @@
+"""A persistence storing each token cache entry as a row of a SQLite database."""
+import contextlib
+import json
+import os
+import threading
+import time
+
+from .filelock import LockError
+from .persistence import BaseEntryPersistence, PersistenceNotFound, _mkdir_p
+
+
+_SQLITE_TOMBSTONE_RETENTION = 1000  # Versions, i.e. writes
+
+
+class SqlitePersistence(BaseEntryPersistence):
+    """A persistence storing each token cache entry as a row of a SQLite database.
+
+    The database is in WAL mode, so that readers never block a writer,
+    nor are blocked by one, and they never see a partial write.
+    Only the changed rows are written, even by a whole-content save().
+    :class:`PersistedTokenCache` uses its :func:`~transaction`
+    rather than a lock file, so there is no dirty read to retry, either.
+
+    Each write increments a version number, which is also stored in
+    each written row, and a deleted entry is kept as a row without value
+    for a while, so that :func:`~changed_since` is a query of newer rows.
+    """
+    is_atomic = True
+
+    def __init__(self, location, timeout=5):
+        """
+        :param string location: The file path of the database.
+        :param float timeout:
+            How many seconds to wait for the write lock of the database,
+            before raising a :class:`LockError`.
+        """
+        if not location:
+            raise ValueError("Requires a file path")
+        self._location = os.path.expanduser(location)
+        _mkdir_p(os.path.dirname(self._location))
+        os.close(os.open(self._location, os.O_RDWR | os.O_CREAT, 0o600))  # Before sqlite does
+        # sqlite3 is optional in CPython, so it is imported only when needed
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        self._lock = threading.RLock()  # The connection is shared by threads
+        self._connection = sqlite3.connect(
+            self._location, timeout=timeout,
+            isolation_level=None,  # We manage transactions by ourselves
+            check_same_thread=False)
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")  # It is persistent
+            # Durable enough in WAL mode, and no fsync() for each transaction
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS entries (
+                credential_type TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT,  -- NULL when the entry has been deleted
+                version INTEGER NOT NULL,
+                PRIMARY KEY (credential_type, key)) WITHOUT ROWID""")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_by_version ON entries (version)")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS meta (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                version INTEGER NOT NULL,
+                modified REAL NOT NULL,
+                horizon INTEGER NOT NULL  -- Deletions until this version are forgotten
+                )""")
+
+    @contextlib.contextmanager
+    def _transaction(self, begin):
+        with self._lock:
+            if self._connection.in_transaction:  # Nested in an outer transaction
+                yield
+                return
+            try:
+                self._connection.execute(begin)
+            except self._connection.OperationalError as exp:  # E.g. database is locked
+                raise LockError("Unable to begin a transaction: {}".format(exp))  # pylint: disable=consider-using-f-string
+            try:
+                yield
+            except:  # pylint: disable=bare-except
+                self._connection.rollback()
+                raise
+            self._connection.commit()
+
+    def transaction(self):
+        """A context manager holding the write lock of the database,
+        which excludes other writers, but not readers.
+        Each load() and save() inside it would be part of this transaction."""
+        return self._transaction("BEGIN IMMEDIATE")
+
+    def _get_meta(self):
+        row = self._connection.execute(
+            "SELECT version, modified, horizon FROM meta").fetchone()
+        if row is None:
+            raise PersistenceNotFound(
+                message="Database not initialized. You can recover by calling a save() first.",
+                location=self._location)
+        return row
+
+    def _write(self, rows):
+        # Write a list of (credential_type, key, value), and return the new version
+        with self.transaction():
+            self._connection.execute("INSERT OR IGNORE INTO meta VALUES (0, 0, 0, 0)")
+            version = self._get_meta()[0]
+            if not rows:
+                return version
+            version += 1
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                [row + (version,) for row in rows])
+            self._connection.execute(
+                "UPDATE meta SET version = ?, modified = ?", (version, time.time()))
+            if version % _SQLITE_TOMBSTONE_RETENTION == 0:
+                horizon = version - _SQLITE_TOMBSTONE_RETENTION
+                self._connection.execute(
+                    "DELETE FROM entries WHERE value IS NULL AND version <= ?", (horizon,))
+                self._connection.execute("UPDATE meta SET horizon = ?", (horizon,))
+            return version
+
+    def get_entry(self, credential_type, key):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM entries WHERE credential_type = ? AND key = ?",
+                (credential_type, key)).fetchone()
+        return json.loads(row[0]) if row and row[0] is not None else None
+
+    def put_entries(self, entries):
+        return self._write([
+            (credential_type, key, json.dumps(entry, sort_keys=True))
+            for credential_type, key, entry in entries])
+
+    def delete_entries(self, names):
+        return self._write([name + (None,) for name in names])
+
+    def changed_since(self, version):
+        with self._transaction("BEGIN"):  # So that both SELECTs see a same snapshot
+            try:
+                current, _, horizon = self._get_meta()
+            except PersistenceNotFound:
+                return 0, [] if not version else None  # Nothing, or it was wiped
+            if version is None:
+                rows = self._connection.execute(
+                    "SELECT credential_type, key, value FROM entries WHERE value IS NOT NULL")
+            elif version < horizon:
+                return current, None
+            else:
+                rows = self._connection.execute(
+                    "SELECT credential_type, key, value FROM entries WHERE version > ?",
+                    (version,))
+            return current, [
+                (credential_type, key, None if value is None else json.loads(value))
+                for credential_type, key, value in rows]
+
+    def save(self, content):
+        # type: (str) -> None
+        """Save the content into this persistence, by writing only the changed rows"""
+        rows = {
+            (credential_type, key): json.dumps(entry, sort_keys=True)
+            for credential_type, entries in (json.loads(content) if content else {}).items()
+            for key, entry in entries.items()}
+        with self.transaction():
+            existing = {
+                (credential_type, key): value for credential_type, key, value
+                in self._connection.execute(
+                    "SELECT credential_type, key, value FROM entries WHERE value IS NOT NULL")}
+            self._write(
+                [name + (value,) for name, value in rows.items()
+                    if existing.get(name) != value]
+                + [name + (None,) for name in existing if name not in rows])
+
+    def load(self):
+        # type: () -> str
+        """Load content from this persistence, as of a consistent snapshot"""
+        cache = {}
+        with self._transaction("BEGIN"):  # So that both SELECTs see a same snapshot
+            self._get_meta()
+            for credential_type, key, value in self._connection.execute(
+                    "SELECT credential_type, key, value FROM entries WHERE value IS NOT NULL"):
+                cache.setdefault(credential_type, {})[key] = json.loads(value)
+        return json.dumps(cache, indent=4)
+
+    def time_last_modified(self):
+        with self._lock:
+            return self._get_meta()[1]
+
+    def fingerprint(self):
+        """The version number, which increases with each write"""
+        with self._lock:
+            return self._get_meta()[0]
+
+    def get_location(self):
+        return self._location
@@ -0,0 +1,131 @@
+"""A file persistence encrypted by a symmetric key provided by the app.
+
+It depends on the ``cryptography`` package, which is imported at run-time,
+so that this module can be imported without it.
+"""
+import base64
+import os
+
+from .persistence import (
+    FilePersistence, PersistenceDecryptionError,
+    _compress, _is_compressed, _decompress, _read_bytes)
+
+
+_SYMMETRIC_MAGIC = b"\x00msal-extensions-aesgcm:1\n"  # Also authenticated as associated data
+_NONCE_SIZE = 12  # Bytes, as recommended for AES-GCM
+_KEY_SIZES = (16, 24, 32)  # Bytes, i.e. AES-128, AES-192 or AES-256
+
+
+def _parse_key(data, key_encoding):
+    # type: (bytes, str) -> bytes
+    """Decode a key by its declared encoding, rather than by guessing it"""
+    if key_encoding == "base64":
+        try:  # Tolerate surrounding whitespace, e.g. the trailing newline of a file
+            key = base64.b64decode(data.strip(), validate=True)
+        except ValueError:  # binascii.Error is a ValueError
+            raise ValueError(
+                "The key is not in base64. Pass key_encoding='raw' for a raw key")
+    elif key_encoding == "raw":
+        key = data
+    else:
+        raise ValueError("Unknown key_encoding: {}".format(key_encoding))  # pylint: disable=consider-using-f-string
+    if len(key) not in _KEY_SIZES:
+        raise ValueError(
+            "The key shall be 16, 24 or 32 bytes after {} decoding, but it is {}".format(  # pylint: disable=consider-using-f-string
+                key_encoding, len(key)))
+    return key
+
+
+def _read_fd(fd):
+    chunks = []
+    while True:
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+class FilePersistenceWithSymmetricKey(FilePersistence):
+    """A generic persistence with data stored in a file,
+    encrypted by AES-GCM with a key provided by the app, on any platform.
+
+    It is meant for headless machines without a keyring,
+    where the key can be provisioned as a secret, e.g. by a container runtime.
+    Encryption happens in-process, so it costs no IPC.
+    Everyone having the key can decrypt the file, so keep the key elsewhere.
+    """
+    is_encrypted = True
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+            self, location, key=None, key_file=None, key_fd=None, key_env=None,
+            key_encoding="base64", atomic=False, compression=None):
+        """Initialization could fail due to unsatisfied dependency,
+        i.e. the ``cryptography`` package.
+
+        Exactly one of ``key``, ``key_file``, ``key_fd`` and ``key_env``
+        shall be provided. It is read once, during initialization,
+        and shall be 16, 24 or 32 bytes after being decoded by ``key_encoding``.
+
+        :param bytes key: The key.
+        :param str key_file: The path of a file containing the key.
+        :param int key_fd: A file descriptor to read the key from, till its end.
+            It will not be closed.
+        :param str key_env: The name of an environment variable containing the key.
+        :param str key_encoding:
+            Either ``"base64"``, which is the default and which tolerates
+            surrounding whitespace, or ``"raw"`` for the key bytes as is.
+            The encoding is never guessed, because a raw key could also
+            happen to be a valid base64 string of a different size.
+        :param bool atomic: See :func:`persistence.FilePersistence.__init__`
+        :param str compression: See :func:`persistence.FilePersistence.__init__`.
+            The content is compressed before being encrypted.
+        """
+        from cryptography.hazmat.primitives.ciphers.aead import (  # pylint: disable=import-outside-toplevel
+            AESGCM)  # This uncertain import is deferred till runtime
+        sources = [
+            source for source in (key, key_file, key_fd, key_env) if source is not None]
+        if len(sources) != 1:
+            raise ValueError(
+                "Requires exactly one of key, key_file, key_fd and key_env")
+        if key_file is not None:
+            with open(os.path.expanduser(key_file), "rb") as handle:
+                key = handle.read()
+        elif key_fd is not None:
+            key = _read_fd(key_fd)
+        elif key_env is not None:
+            if not os.environ.get(key_env):
+                raise ValueError("Environment variable {} is not defined".format(key_env))  # pylint: disable=consider-using-f-string
+            key = os.fsencode(os.environ[key_env])
+        self._aead = AESGCM(_parse_key(key, key_encoding))
+        super(FilePersistenceWithSymmetricKey, self).__init__(
+            location, atomic=atomic, compression=compression)
+
+    def save(self, content):
+        # type: (str) -> None
+        nonce = os.urandom(_NONCE_SIZE)  # Never reuse a nonce with a same key
+        self._write(_SYMMETRIC_MAGIC + nonce + self._aead.encrypt(
+            nonce,
+            _compress(content, self._compression) if self._compression
+                else content.encode("utf-8"),
+            _SYMMETRIC_MAGIC), 'wb')
+
+    def load(self):
+        # type: () -> str
+        from cryptography.exceptions import InvalidTag  # pylint: disable=import-outside-toplevel
+        data = _read_bytes(self._location)
+        if not data.startswith(_SYMMETRIC_MAGIC):
+            raise PersistenceDecryptionError(
+                message="Content was not encrypted by this persistence. "
+                    "App developer should migrate by calling save(plaintext) first.",
+                location=self._location,
+                )
+        nonce_end = len(_SYMMETRIC_MAGIC) + _NONCE_SIZE
+        try:
+            data = self._aead.decrypt(
+                data[len(_SYMMETRIC_MAGIC):nonce_end], data[nonce_end:], _SYMMETRIC_MAGIC)
+        except InvalidTag:
+            raise PersistenceDecryptionError(
+                message="Decryption failed, due to a wrong key or tampered content",
+                location=self._location,
+                )
+        return (_decompress(data) if _is_compressed(data) else data).decode("utf-8")
@@ -1,23 +1,119 @@
 """Generic functions and types for working with a TokenCache that is not platform specific."""
+import collections
+import contextlib
+import json
 import os
+import re
+import threading
 import time
 import logging
+import weakref
 
 import msal
 
 try:  # It needs portalocker
     from .cache_lock import (  # pylint: disable=unused-import
         CrossPlatLock,
+        CrossPlatReadWriteLock,
         LockError,  # We don't use LockError in this file, but __init__.py uses it.
         )
 except ImportError:  # Falls back to file-based lock
-    from .filelock import CrossPlatLock, LockError  # pylint: disable=unused-import
-from .persistence import _mkdir_p, PersistenceNotFound
+    from .filelock import (  # pylint: disable=unused-import
+        CrossPlatLock, CrossPlatReadWriteLock, LockError)
+from .persistence import _mkdir_p, PersistenceNotFound, BaseEntryPersistence
+from .journal import Journal
+from .index import SecondaryIndex
+from .watcher import PersistenceWatcher
 
 
 logger = logging.getLogger(__name__)
+_JOURNAL_COMPACTION_THRESHOLD = 64 * 1024  # Small journals are not worth compacting
+# In the output of json.dumps(..., indent=4), only top-level keys are indented by 4 spaces
+_SECTION_START = re.compile(r'^ {4}"', re.MULTILINE)
 
-class PersistedTokenCache(msal.SerializableTokenCache):
+
+def _split_sections(content):
+    # type: (str) -> Optional[dict]
+    """Split a JSON object serialized by msal, i.e. with indent=4,
+    into a dict mapping each top-level key to the JSON text of its value,
+    without parsing those values.
+
+    :return: None if content is not in such a layout.
+    """
+    content = content.strip()
+    starts = [match.start() for match in _SECTION_START.finditer(content)]
+    if not (content.startswith("{") and content.endswith("}")) or content[
+            1:starts[0] if starts else -1].strip():
+        return None  # Not in the expected layout, e.g. a compact JSON
+    decoder = json.JSONDecoder()
+    sections = {}
+    for start, end in zip(starts, starts[1:] + [len(content) - 1]):
+        name, colon = decoder.raw_decode(content, start + 4)
+        if content[colon] != ":":
+            return None
+        sections[name] = content[colon + 1:end].rstrip().rstrip(",")
+    return sections
+
+
+
+def _is_matching(entry, query, target_set):
+    # type: (dict, Optional[dict], set) -> bool
+    """Same criteria as msal's search(), i.e. the entry contains the query,
+    and its target contains the target_set"""
+    for key, value in (query or {}).items():
+        if key == "environment" and isinstance(value, str):
+            value = value.lower()  # Same as msal, which stores it in lower case
+        if key not in entry or entry[key] != value:
+            return False
+    return target_set <= set(entry.get("target", "").split())
+
+
+# The optional features of PersistedTokenCache, all of which are off by default
+_Options = collections.namedtuple("_Options", [
+    "journal", "shared_read_lock", "lock_policy", "share_snapshot",
+    "group_commit_window", "background_reload", "indexed", "purge_expired_after",
+    "max_entries", "max_bytes", "lazy_load", "observer",
+    ], defaults=[False, False, None, False, None, False, False, None, None, None, False, None])
+
+
+# It is a plain record of state, which its caches manipulate under its locks
+class _Snapshot(object):  # pylint: disable=too-many-instance-attributes,too-few-public-methods
+    """In-memory state of a persistence, which may be shared by multiple caches"""
+    def __init__(self):
+        self.cache = {}  # Same format as the one in msal.TokenCache
+        self.lock = threading.RLock()  # Used as msal.TokenCache's in-process lock
+        self.fingerprint = None  # Fingerprint of what we loaded or saved last
+        self.size = 0  # Size of the persistence we loaded or saved last
+        self.journal_position = None  # Where we have replayed the journal up to
+        self.index = None  # Built lazily, and reset whenever the cache is replaced
+        self.access_times = {}  # Maps (credential_type, key) to its last search hit
+        self.sections = {}  # Maps credential type to its JSON text not yet deserialized
+        self.pending = []  # Changes waiting for a group commit
+        self.pending_lock = threading.Lock()  # Guards the pending list only
+        self.commit_lock = threading.Lock()  # Held by whoever commits the pending list
+
+
+class _PendingChange(object):  # pylint: disable=too-few-public-methods
+    def __init__(self, change):
+        self.change = change  # A tuple of modify()'s parameters
+        self.done = False
+        self.error = None
+
+
+_shared_snapshots = weakref.WeakValueDictionary()  # Keyed by persistence location
+_shared_snapshots_lock = threading.Lock()
+
+def _get_shared_snapshot(location):
+    key = os.path.normcase(os.path.abspath(location))
+    with _shared_snapshots_lock:
+        snapshot = _shared_snapshots.get(key)
+        if snapshot is None:
+            snapshot = _shared_snapshots[key] = _Snapshot()
+        return snapshot
+
+
+# Its attributes are the persistence, the options, and the helpers built from them
+class PersistedTokenCache(msal.SerializableTokenCache):  # pylint: disable=too-many-instance-attributes
     """A token cache backed by a persistence layer, coordinated by a file lock,
     to sustain a certain level of multi-process concurrency for a desktop app.
 
@@ -28,7 +124,8 @@ class PersistedTokenCache(msal.SerializableTokenCache):
     (known as a persistence). The goal is to have Single Sign On (SSO).
 
     Each instance of ``PersistedTokenCache`` holds a snapshot of the token cache
-    in memory.
+    in memory, or shares one with other instances in the same process
+    when they opt in via ``share_snapshot``.
     Each :func:`~find` call will
     automatically reload token cache from the persistence when necessary,
     so that it will have fresh data.
@@ -43,52 +140,718 @@ class PersistedTokenCache(msal.SerializableTokenCache):
     nor the "flush back to persistence" behavior.
     """
 
-    def __init__(self, persistence, lock_location=None):
+    # The base class stores its data in self._cache and self._lock.
+    # We redirect them into a snapshot, so that they can be shared.
+    _cache = property(
+        lambda self: self._snapshot.cache,
+        lambda self, value: self._snapshot.__dict__.update(
+            cache=value, index=None, sections={}))
+    _lock = property(
+        lambda self: self._snapshot.lock,
+        lambda self, value: setattr(self._snapshot, "lock", value))
+
+    def __init__(self, persistence, lock_location=None, **kwargs):
+        """
+        :param persistence: A persistence instance, such as ``FilePersistence``.
+            When it is a :class:`BaseEntryPersistence`, such as ``SqlitePersistence``,
+            each :func:`~modify` writes only the changed entries,
+            and each reload reads only the entries changed since last time.
+        :param str lock_location:
+            Optional. Defaults to the persistence location plus ``.lockfile``.
+        :param kwargs:
+            The optional features below, which shall be passed by keyword.
+        :param bool journal:
+            Opt-in. When True, each :func:`~modify` appends a small change record
+            into a journal file next to the persistence (plus ``.journal``),
+            rather than rewriting the whole persistence.
+            The journal is folded back into the persistence once it outgrows it.
+            All processes sharing a persistence shall use a same journal setting.
+            Since the journal is stored in plaintext,
+            it is only available to unencrypted persistence.
+        :param bool shared_read_lock:
+            Opt-in. When True, :func:`~search` reloads under a shared lock,
+            which many readers can hold at the same time,
+            while :func:`~modify` additionally holds it exclusively when writing.
+            Readers would then never see a partial write, therefore need no retry.
+            The lock file is the ``lock_location`` plus ``.rw``.
+            All processes sharing a persistence shall use a same setting.
+        :param LockPolicy lock_policy:
+            Optional. Defines how long and how often to wait for the lock(s).
+        :param bool share_snapshot:
+            Opt-in. When True, all the instances opting in within current process,
+            which are backed by a same persistence location, would share one
+            in-memory snapshot, so that the persistence is loaded only once
+            for all of them. They shall also use same settings as each other.
+        :param float group_commit_window:
+            Opt-in. When it is a number, concurrent :func:`~modify` calls
+            (from multiple threads, and from instances sharing a snapshot)
+            are queued and then committed together, under a single lock
+            acquisition and with a single write, each caller returning
+            only after its change has been written.
+            Each caller would wait this many seconds for more changes to join,
+            which can be 0. Likewise, all the changes made by one :func:`~add`
+            would be committed together.
+        :param bool background_reload:
+            Opt-in. When True, a background thread watches the persistence
+            (or the signal file of an encrypted persistence),
+            and reloads it into a fresh snapshot as soon as it changes,
+            which is then swapped in atomically.
+            A :func:`~search` would then read only the in-memory snapshot,
+            without doing any I/O.
+            Call :func:`~close` to stop the background thread.
+            Changes are noticed right away on Linux, via inotify,
+            or within a second elsewhere.
+        :param bool indexed:
+            Opt-in. When True, the in-memory snapshot is indexed by
+            ``home_account_id``, ``client_id``, ``environment``, ``realm``
+            and each scope of ``target``, so that a :func:`~search`
+            with any of them would only examine the matching entries,
+            rather than every entry of a credential type.
+            The index is rebuilt on the next search after each reload,
+            and is updated incrementally by each :func:`~modify`.
+        :param float purge_expired_after:
+            Opt-in. When it is a number, each :func:`~modify` would also remove
+            the access tokens which have expired for more than this many seconds,
+            while it is holding the lock and writing anyway.
+            See also :func:`~compact`.
+        :param int max_entries:
+            Opt-in. When the cache holds more entries than this,
+            each :func:`~modify` would evict the least recently used ones,
+            while it is holding the lock and writing anyway.
+            An entry is used when it is returned by a :func:`~search`
+            in current process. Entries not yet used by current process
+            are considered used when they were cached.
+            App metadata, which is tiny, is never evicted.
+        :param int max_bytes:
+            Opt-in. Same as ``max_entries``, but caps the serialized size
+            of the cache, which is checked against the size of the last
+            load or save, so it could be exceeded by one write.
+            It does not apply to an entry-granular persistence.
+        :param bool lazy_load:
+            Opt-in. When True, a reload only splits the persistence into
+            sections, one per credential type, and each section is deserialized
+            when it is first needed, e.g. by a :func:`~search` of that type.
+            It relies on the layout of a persistence saved by this package.
+            Content in any other layout is still deserialized in full.
+        :param observer:
+            Optional. A callable to be notified of where the time goes,
+            e.g. to feed a metrics or tracing system.
+            It will be called as ``observer(phase, seconds, **details)``
+            after each of the following phases:
+
+            * ``"lock_wait"``: Waited for a lock, with detail ``lock``
+              being ``"exclusive"``, ``"read"`` or ``"write"``.
+            * ``"load"`` and ``"save"``: The I/O of the persistence,
+              with detail ``bytes`` being the size of the content,
+              or ``entries`` being the number of entries
+              for an entry-granular persistence.
+            * ``"deserialize"`` and ``"serialize"``: Same as above,
+              but for the (de)serialization of the content.
+            * ``"search_retry"``: A :func:`~search` will retry after
+              this many seconds, with details ``attempt`` and ``error``.
+
+            Exceptions raised by the observer are logged and then ignored.
+        """
+        self._options = options = _Options(**kwargs)
+        self._snapshot = _Snapshot()  # Base class would initialize it
         super(PersistedTokenCache, self).__init__()
+        if options.share_snapshot:  # Replace the one initialized by base class
+            self._snapshot = _get_shared_snapshot(persistence.get_location())
         self._lock_location = (
             os.path.expanduser(lock_location) if lock_location
             else persistence.get_location() + ".lockfile")
         _mkdir_p(os.path.dirname(self._lock_location))
         self._persistence = persistence
-        self._last_sync = 0  # _last_sync is a Unixtime
         self.is_encrypted = persistence.is_encrypted
+        if options.journal and persistence.is_encrypted:
+            raise ValueError(
+                "Journal would store tokens in plaintext, "
+                "therefore it can not be used with an encrypted persistence")
+        self._entry_granular = isinstance(persistence, BaseEntryPersistence)
+        if options.journal and self._entry_granular:
+            raise ValueError("An entry-granular persistence needs no journal")
+        self._journal = Journal(
+            persistence.get_location() + ".journal") if options.journal else None
+        self._rw_lock_location = (
+            self._lock_location + ".rw" if options.shared_read_lock else None)
+        self._batch = threading.local()  # Tracks changes made inside an add()
+        self._watcher = PersistenceWatcher(
+            [persistence.get_location()]
+                + ([self._journal.get_location()] if self._journal else []),
+            self._reload_in_background,
+            ).start() if options.background_reload else None
+
+    def close(self):
+        """Stop the background reload, if any.
+
+        This cache remains usable afterwards, and reloads by itself when necessary.
+        """
+        if self._watcher:
+            self._watcher.stop()
+            self._watcher = None
+
+    def _notify(self, phase, seconds, **details):
+        if self._options.observer:
+            try:
+                self._options.observer(phase, seconds, **details)
+            except Exception:  # pylint: disable=broad-except
+                logger.warning("Observer failed to handle %s", phase, exc_info=True)
+
+    @contextlib.contextmanager
+    def _observe(self, phase, **details):
+        # The body may add more details into the yielded dict
+        start = time.perf_counter()
+        yield details
+        self._notify(phase, time.perf_counter() - start, **details)
+
+    @contextlib.contextmanager
+    def _observe_lock(self, lock, name):
+        with contextlib.ExitStack() as stack:
+            with self._observe("lock_wait", lock=name):
+                stack.enter_context(lock)
+            yield
+
+    def _cross_process_lock(self):
+        # A persistence with its own transaction, e.g. SqlitePersistence, needs no lock file
+        transaction = getattr(self._persistence, "transaction", None)
+        return self._observe_lock(
+            transaction() if transaction
+                else CrossPlatLock(self._lock_location, policy=self._options.lock_policy),
+            "exclusive")
+
+    def _snapshot_lock(self):
+        # Instances sharing a snapshot reload it one at a time, so that they
+        # won't reload a same data. Otherwise, same as the base class,
+        # the snapshot is only locked by each in-memory operation on its own.
+        return self._lock if self._options.share_snapshot else contextlib.nullcontext()
+
+    @contextlib.contextmanager
+    def _locked(self, *locks):
+        # Enter the cross-process locks, each created by a callable,
+        # and then the in-process lock of a shared snapshot.
+        # The latter comes last, so that a thread would not hold it while waiting
+        # for other processes, which would also stall the searches of this process.
+        # msal's own add() and search() may call modify() while holding it, though,
+        # so when another thread holds it, we release the cross-process locks
+        # before waiting for that thread, which may be waiting for them.
+        while True:
+            with contextlib.ExitStack() as stack:
+                for lock in locks:
+                    stack.enter_context(lock())
+                if not self._options.share_snapshot:
+                    yield
+                    return
+                if self._lock.acquire(blocking=False):
+                    try:
+                        yield
+                    finally:
+                        self._lock.release()
+                    return
+            with self._lock:
+                pass  # Its holder is done by now, and we will retry from scratch
+
+    def _load_content(self):
+        with self._observe("load") as details:
+            content = self._persistence.load()
+            details["bytes"] = len(content or "")
+        return content
+
+    def _load(self):
+        # Fingerprint is taken before load(), so a concurrent write
+        # would at worst cause one more reload next time, but never a miss.
+        fingerprint = self._persistence.fingerprint()
+        content = self._load_content()
+        with self._observe("deserialize", bytes=len(content or "")):
+            self._deserialize(content)
+        self._snapshot.fingerprint = fingerprint
+        self._snapshot.size = len(content or "")
+
+    def _deserialize(self, content):
+        sections = _split_sections(content) if self._options.lazy_load and content else None
+        if sections is None:
+            self.deserialize(content)
+            return
+        with self._lock:
+            self._cache = {}
+            self._snapshot.sections = sections
+            self.has_state_changed = False
+
+    def _materialize(self, credential_types=None):
+        # Deserialize the sections deferred by lazy_load, or all of them by default
+        if not self._snapshot.sections:
+            return
+        with self._lock:
+            sections = self._snapshot.sections
+            names = [name for name in (
+                list(sections) if credential_types is None else credential_types
+                ) if name in sections]
+            try:
+                for name in names:
+                    self._cache[name] = json.loads(sections.pop(name))
+            except ValueError:
+                # Presumably a dirty read. Let next reload start over.
+                self._snapshot.fingerprint = None
+                self._snapshot.journal_position = None
+                raise
+            if names:
+                self._snapshot.index = None  # It may have indexed only other sections
+
+    def _remote(self, name, *args, **kwargs):
+        # A persistence served by a daemon would do the work on our behalf,
+        # and return (True, result), or (False, None) when the daemon is unreachable.
+        method = getattr(self._persistence, name, None)
+        return method(*args, **kwargs) if method else (False, None)
+
+    def _get(self, credential_type, key, default=None):
+        served, entry = self._remote("remote_get", credential_type, key)
+        if served:
+            return default if entry is None else entry
+        self._materialize([credential_type])
+        return super(PersistedTokenCache, self)._get(credential_type, key, default=default)
+
+    def serialize(self):
+        self._materialize()
+        return super(PersistedTokenCache, self).serialize()
+
+    def _save(self):
+        # Shall only be called when holding the lock
+        with self._observe("serialize") as details:
+            content = self.serialize()
+            details["bytes"] = len(content)
+        with self._observe("save", bytes=len(content)):
+            self._persistence.save(content)
+        self._snapshot.size = len(content)
+        try:
+            # We are still holding the lock, so this fingerprint is of our own
+            # write, which we recognize in order to avoid reloading it next time.
+            self._snapshot.fingerprint = self._persistence.fingerprint()
+        except PersistenceNotFound:  # E.g. the save() above was a NO-OP
+            self._snapshot.fingerprint = None
 
-    def _reload_if_necessary(self):
-        # type: () -> None
+    def _reload_if_necessary(self, locked=False):
+        # type: (bool) -> None
         """Reload cache from persistence layer, if necessary"""
+        if self._journal:
+            self._replay_journal(locked)
+            return
+        if self._entry_granular:
+            self._reload_changes()
+            return
         try:
-            if self._last_sync < self._persistence.time_last_modified():
-                self.deserialize(self._persistence.load())
-                self._last_sync = time.time()
+            with self._snapshot_lock():
+                if self._persistence.fingerprint() != self._snapshot.fingerprint:
+                    self._load()
         except PersistenceNotFound:
             # From cache's perspective, a nonexistent persistence is a NO-OP.
             pass
         # However, existing data unable to be decrypted will still be bubbled up.
 
-    def modify(self, credential_type, old_entry, new_key_value_pairs=None):
-        with CrossPlatLock(self._lock_location):
+    def _reload_in_background(self):
+        # Called by the watcher thread, which stops trusting the snapshot if we fail
+        reloaded = False
+        try:
+            self._swap_in_fresh_snapshot()
+            reloaded = True
+        finally:
+            if not reloaded:  # Whatever has been half loaded, the next reload starts over
+                self._snapshot.fingerprint = None
+                self._snapshot.journal_position = None
+
+    def _swap_in_fresh_snapshot(self):
+        if self._journal or self._entry_granular:  # Replaying changes is cheap
             self._reload_if_necessary()
-            super(PersistedTokenCache, self).modify(
-                credential_type,
-                old_entry,
-                new_key_value_pairs=new_key_value_pairs)
-            self._persistence.save(self.serialize())
-            self._last_sync = time.time()
+            return
+        expected = self._snapshot.fingerprint
+        try:
+            fingerprint = self._persistence.fingerprint()
+        except PersistenceNotFound:
+            return
+        if fingerprint == expected:
+            return
+        content = self._load_content()
+        with self._observe("deserialize", bytes=len(content or "")):  # Outside of the lock
+            sections = _split_sections(content) if self._options.lazy_load and content else None
+            cache = {} if sections is not None else json.loads(content) if content else {}
+        with self._lock:
+            if self._snapshot.fingerprint != expected:
+                return  # A newer content has been loaded or saved by others meanwhile
+            self._cache = cache  # The swap. Readers see either the old or the new one.
+            self._snapshot.sections = sections or {}
+            self.has_state_changed = False
+            self._snapshot.fingerprint = fingerprint
+            self._snapshot.size = len(content)
+
+    def _replay_journal(self, locked):
+        records, position = self._journal.read(self._snapshot.journal_position)
+        try:
+            fingerprint = self._persistence.fingerprint()
+        except PersistenceNotFound:
+            fingerprint = None
+        if (self._snapshot.journal_position is None  # Initial load
+                or position[0] != self._snapshot.journal_position[0]  # Journal was compacted
+                or fingerprint != self._snapshot.fingerprint):  # Or snapshot was rewritten
+            if not locked:
+                # Lock-free reading of the journal tail is fine,
+                # but a snapshot needs to be loaded together with its journal.
+                with self._locked(self._cross_process_lock):
+                    self._replay_journal(locked=True)
+                return
+            records, position = self._journal.read()
+            try:
+                self._load()
+            except PersistenceNotFound:
+                self.deserialize(None)
+                self._snapshot.fingerprint = None
+                self._snapshot.size = 0
+        with self._lock:
+            self._materialize(set(record["credential_type"] for record in records))
+            for record in records:
+                entries = self._cache.setdefault(record["credential_type"], {})
+                if record["entry"] is None:
+                    entries.pop(record["key"], None)
+                else:
+                    entries[record["key"]] = record["entry"]
+                self._update_index(record["credential_type"], record["key"])
+        self._snapshot.journal_position = position
+
+    def _reload_changes(self):
+        # Catch up with the changes of an entry-granular persistence
+        with self._lock, self._observe("load") as details:
+            version, changes = self._persistence.changed_since(self._snapshot.fingerprint)
+            if changes is None or self._snapshot.fingerprint is None:
+                if changes is None:  # Too far behind to catch up
+                    version, changes = self._persistence.changed_since(None)
+                self._cache = {}  # The changes are all the entries
+            for credential_type, key, entry in changes:
+                entries = self._cache.setdefault(credential_type, {})
+                if entry is None:
+                    entries.pop(key, None)
+                else:
+                    entries[key] = entry
+                self._update_index(credential_type, key)
+            self._snapshot.fingerprint = version
+            details["entries"] = len(changes)
+
+    def _save_entries(self, changes):
+        # Shall only be called when holding the lock(s), after _reload_changes()
+        names = set(
+            (credential_type, self.key_makers[credential_type](**old_entry))
+            for credential_type, old_entry, _ in changes)
+        with self._lock:
+            current = [
+                (credential_type, key, self._cache.get(credential_type, {}).get(key))
+                for credential_type, key in names]
+        with self._observe("save", entries=len(current)):
+            version = self._persistence.put_entries(
+                [change for change in current if change[2] is not None])
+            deleted = [(credential_type, key)
+                for credential_type, key, entry in current if entry is None]
+            if deleted:
+                version = self._persistence.delete_entries(deleted)
+        # We are still holding the lock, so this version is of our own write,
+        # which we recognize in order to avoid reloading it next time.
+        self._snapshot.fingerprint = version
+
+    def _append_to_journal(self, changes):
+        # Shall only be called when holding the lock, after _replay_journal()
+        if self._snapshot.journal_position[0] is None:  # Journal does not exist yet
+            self._snapshot.journal_position = self._journal.reset()
+        self._snapshot.journal_position = self._journal.append([{
+            "credential_type": credential_type,
+            "key": self.key_makers[credential_type](**old_entry),
+            "entry": dict(old_entry, **new_key_value_pairs)
+                if new_key_value_pairs else None,
+            } for credential_type, old_entry, new_key_value_pairs in changes
+            ], self._snapshot.journal_position)
+        if self._snapshot.journal_position[1] > max(
+                self._snapshot.size, _JOURNAL_COMPACTION_THRESHOLD):
+            self._compact_journal()
+
+    def _compact_journal(self):
+        # Shall only be called when holding the lock
+        self._save()  # Snapshot first, so that the journal is never lost
+        try:
+            self._snapshot.journal_position = self._journal.reset()
+        except OSError:  # E.g. journal opened by a reader on Windows. Try next time.
+            logger.debug("Unable to compact journal", exc_info=True)
+
+    def _write_lock(self):
+        # Readers are excluded when we hold this. Its lock ordering comes after CrossPlatLock.
+        return self._observe_lock(CrossPlatReadWriteLock(
+            self._rw_lock_location, policy=self._options.lock_policy,
+            ), "write") if self._rw_lock_location else contextlib.nullcontext()
+
+    def _commit(self, changes):
+        # Apply a list of (credential_type, old_entry, new_key_value_pairs),
+        # with a single lock acquisition and a single write, or by a daemon.
+        served, _ = self._remote("remote_commit", changes)
+        if served:
+            return
+        with self._locked(self._cross_process_lock, self._write_lock):
+            self._commit_locked(changes)
+
+    def _commit_locked(self, changes):
+        # Shall only be called when holding the lock(s)
+        self._reload_if_necessary(locked=True)
+        self._apply(changes)
+        if self._options.purge_expired_after is not None:
+            purged = self._find_expired_access_tokens(self._options.purge_expired_after)
+            self._apply(purged)
+            changes = list(changes) + purged
+        if self._options.max_entries or self._options.max_bytes:
+            evicted = self._find_least_recently_used(changes)
+            self._apply(evicted)
+            changes = list(changes) + evicted
+        self._persist(changes)
+
+    def _persist(self, changes):
+        # Shall only be called when holding the lock(s), after the changes are applied
+        if self._journal:
+            self._append_to_journal(changes)
+        elif self._entry_granular:
+            self._save_entries(changes)
+        else:
+            self._save()
+
+    def _apply(self, changes):
+        self._materialize(set(change[0] for change in changes))
+        for credential_type, old_entry, new_key_value_pairs in changes:
+            with self._lock:  # The index is guarded by it, same as the cache
+                super(PersistedTokenCache, self).modify(
+                    credential_type,
+                    old_entry,
+                    new_key_value_pairs=new_key_value_pairs)
+                self._update_index(
+                    credential_type, self.key_makers[credential_type](**old_entry))
+
+    def _find_expired_access_tokens(self, grace):
+        # type: (float) -> list
+        """Return the removals of access tokens expired for more than grace seconds"""
+        deadline = time.time() - grace
+        self._materialize([self.CredentialType.ACCESS_TOKEN])
+        with self._lock:
+            return [
+                (self.CredentialType.ACCESS_TOKEN, at, None)
+                for at in self._cache.get(self.CredentialType.ACCESS_TOKEN, {}).values()
+                if int(at["expires_on"]) < deadline]
+
+    def _last_used(self, credential_type, key, entry):
+        return self._snapshot.access_times.get((credential_type, key)) or int(
+            entry.get("last_modification_time") or entry.get("cached_at") or 0)
+
+    def _find_least_recently_used(self, changes):
+        # type: (list) -> list
+        """Return the removals of least recently used entries beyond the caps,
+        other than those just written by changes"""
+        written = set(
+            (credential_type, self.key_makers[credential_type](**old_entry))
+            for credential_type, old_entry, _ in changes)
+        self._materialize()  # Every section is a candidate
+        max_entries, max_bytes = self._options.max_entries, self._options.max_bytes
+        with self._lock:
+            excess_entries = sum(len(entries) for entries in self._cache.values()
+                ) - max_entries if max_entries else 0
+            excess_bytes = self._snapshot.size - max_bytes if max_bytes else 0
+            if excess_entries <= 0 and excess_bytes <= 0:
+                return []
+            candidates = sorted(
+                (
+                    (self._last_used(credential_type, key, entry), credential_type, key)
+                    for credential_type, entries in self._cache.items()
+                    if credential_type != self.CredentialType.APP_METADATA
+                    for key, entry in entries.items()
+                    if (credential_type, key) not in written
+                ),
+                key=lambda candidate: candidate[0])
+            evicted = []
+            for _, credential_type, key in candidates:
+                if excess_entries <= 0 and excess_bytes <= 0:
+                    break
+                entry = self._cache[credential_type][key]
+                evicted.append((credential_type, entry, None))
+                self._snapshot.access_times.pop((credential_type, key), None)
+                excess_entries -= 1
+                excess_bytes -= len(json.dumps(entry, indent=4))  # Roughly its share
+            return evicted
+
+    def _track_access(self, credential_type, entries):
+        for entry in entries:
+            self._snapshot.access_times[
+                (credential_type, self.key_makers[credential_type](**entry))] = time.time()
+            yield entry
+
+    def compact(self, grace=None):
+        # type: (Optional[float]) -> int
+        """Remove expired access tokens from the persistence,
+        and fold the journal (if any) back into the persistence.
+
+        It is meant to be called periodically, e.g. by a maintenance job.
+
+        :param float grace:
+            Only remove the access tokens which have expired for more than
+            this many seconds. Defaults to the ``purge_expired_after``
+            of this cache, or 0.
+        :return: The number of removed access tokens.
+        """
+        if grace is None:
+            grace = self._options.purge_expired_after or 0
+        with self._locked(self._cross_process_lock, self._write_lock):
+            self._reload_if_necessary(locked=True)
+            purged = self._find_expired_access_tokens(grace)
+            self._apply(purged)
+            if self._journal:
+                self._compact_journal()
+            elif purged:
+                self._persist(purged)
+        return len(purged)
+
+    def _update_index(self, credential_type, key):
+        # Shall be called with the in-process lock held, after an entry changed
+        if self._snapshot.index is not None:
+            self._snapshot.index.update(
+                credential_type, key, self._cache.get(credential_type, {}).get(key))
+
+    def _search_index(self, credential_type, target=None, query=None, **kwargs):
+        # Same as msal's search, except that it examines only the candidates.
+        # The now= is only forwarded when given, because msal accepts it since 1.32
+        with self._lock:
+            if self._snapshot.index is None:
+                self._snapshot.index = SecondaryIndex(self._cache)
+            keys = self._snapshot.index.lookup(credential_type, target=target, query=query)
+        if keys is None:  # Nothing to narrow it down
+            yield from super(PersistedTokenCache, self).search(
+                credential_type, target=target, query=query, **kwargs)
+            return
+        with self._lock:
+            entries = self._cache.get(credential_type, {})
+            target_set = set(target or [])
+            now = kwargs.get("now")
+            now = int(time.time() if now is None else now)
+            expired_access_tokens = []
+            matches = []
+            for key in keys:
+                entry = entries.get(key)
+                if entry is None:
+                    continue
+                if (credential_type == self.CredentialType.ACCESS_TOKEN
+                        and int(entry["expires_on"]) < now):
+                    expired_access_tokens.append(entry)
+                    continue
+                if _is_matching(entry, query, target_set) and not (
+                        # Entries with ext_cache_key must not match queries without one
+                        credential_type == self.CredentialType.ACCESS_TOKEN
+                        and "ext_cache_key" in entry
+                        and "ext_cache_key" not in (query or {})):
+                    matches.append(entry)
+        for at in expired_access_tokens:  # Outside of the lock, for modify() to commit
+            self.remove_at(at)
+        yield from matches
+
+    def _search_snapshot(self, credential_type, **kwargs):
+        self._materialize([credential_type])
+        if self._options.indexed:
+            result = self._search_index(credential_type, **kwargs)
+        else:
+            result = super(PersistedTokenCache, self).search(credential_type, **kwargs)
+        if self._options.max_entries or self._options.max_bytes:
+            return self._track_access(credential_type, result)
+        return result
+
+    def _commit_pending(self):
+        # Shall be called with the commit lock held.
+        # Commit all pending changes, including those enqueued by other threads,
+        # and let each of them know its outcome.
+        with self._snapshot.pending_lock:
+            batch, self._snapshot.pending = self._snapshot.pending, []
+        if not batch:
+            return
+        try:
+            self._commit([pending.change for pending in batch])
+        except Exception as ex:  # pylint: disable=broad-except
+            for pending in batch:
+                pending.error = ex
+        finally:
+            for pending in batch:
+                pending.done = True
+
+    def modify(self, credential_type, old_entry, new_key_value_pairs=None):
+        change = (credential_type, old_entry, new_key_value_pairs)
+        if self._options.group_commit_window is None:
+            self._commit([change])
+            return
+        in_add = getattr(self._batch, "changes", None) is not None
+        # threading.Condition relies on this method of an RLock, too
+        if not in_add and self._lock._is_owned():  # pylint: disable=protected-access
+            # E.g. msal's search() removing an expired access token while holding
+            # the in-process lock. Waiting for more changes would stall other threads.
+            self._commit([change])
+            return
+        pending = _PendingChange(change)
+        with self._snapshot.pending_lock:
+            self._snapshot.pending.append(pending)
+        if in_add:
+            self._batch.changes.append(pending)
+            return  # It will be committed when add() finishes
+        if self._options.group_commit_window:
+            # Before taking any lock, for others to join
+            time.sleep(self._options.group_commit_window)
+        with self._snapshot.commit_lock:
+            # By now, the thread which held the lock before us might have
+            # committed our change together with its own
+            if not pending.done:
+                self._commit_pending()
+        if pending.error:
+            raise pending.error
+
+    def add(self, event, **kwargs):
+        if self._options.group_commit_window is None:
+            return super(PersistedTokenCache, self).add(event, **kwargs)
+        # An add() would otherwise cause multiple commits, one per each entry
+        self._batch.changes = []
+        try:
+            return super(PersistedTokenCache, self).add(event, **kwargs)
+        finally:
+            changes, self._batch.changes = self._batch.changes, None
+            with self._snapshot.commit_lock:
+                self._commit_pending()
+            for pending in changes:
+                if pending.error:
+                    raise pending.error
 
     def search(self, credential_type, **kwargs):  # pylint: disable=arguments-differ
+        served, entries = self._remote("remote_search", credential_type, **kwargs)
+        if served:
+            return entries
+        if self._watcher and self._watcher.is_primed():
+            # The watcher keeps the snapshot fresh, so there is no need to reload
+            return self._search_snapshot(credential_type, **kwargs)
+        if self._rw_lock_location:
+            with self._locked(lambda: self._observe_lock(CrossPlatReadWriteLock(
+                    self._rw_lock_location, shared=True, policy=self._options.lock_policy,
+                    ), "read")):
+                # Writers are excluded, so it is as good as holding CrossPlatLock
+                self._reload_if_necessary(locked=True)
+            return self._search_snapshot(credential_type, **kwargs)
         # Use optimistic locking rather than CrossPlatLock(self._lock_location)
         retry = 3
+        # An atomic persistence won't be caught in the middle of a write,
+        # so there is no point to wait for a writer to finish
+        retry_interval = 0 if getattr(self._persistence, "is_atomic", False) else 0.5
         for attempt in range(1, retry + 1):
             try:
                 self._reload_if_necessary()
-            except Exception:  # pylint: disable=broad-except
+                # A lazily loaded section may turn out to be a dirty read, too
+                self._materialize([credential_type])
+            except Exception as ex:  # pylint: disable=broad-except
                 # Presumably other processes are writing the file, causing dirty read
                 if attempt < retry:
                     logger.debug("Unable to load token cache file in No. %d attempt", attempt)
-                    time.sleep(0.5)
+                    self._notify("search_retry", retry_interval, attempt=attempt, error=ex)
+                    if retry_interval:
+                        time.sleep(retry_interval)
                 else:
                     raise  # End of retry. Re-raise the exception as-is.
             else:  # If reload encountered no error, the data is considered intact
-                return super(PersistedTokenCache, self).search(credential_type, **kwargs)
+                return self._search_snapshot(credential_type, **kwargs)
         return []  # Not really reachable here. Just to keep pylint happy.
 
@@ -0,0 +1,159 @@
+"""Watches files in a background thread, and calls back when they change.
+
+On Linux, it uses inotify via ctypes, so that a change is noticed right away
+without any polling. Elsewhere, or when inotify is unavailable,
+it falls back to calling back periodically,
+and the callback is expected to do its own cheap change detection, such as a stat().
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import weakref
+
+
+logger = logging.getLogger(__name__)
+
+_IN_ATTRIB = 0x4  # E.g. a touch()
+_IN_CLOSE_WRITE = 0x8  # An in-place write is finished
+_IN_MOVED_TO = 0x80  # E.g. an atomic replace
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+_POLLING_INTERVAL = 1  # Seconds
+
+
+class _Inotify(object):
+    """Watches some file names inside their directories.
+
+    Directories rather than files are watched,
+    so that we can still notice a file being replaced or re-created.
+    """
+    def __init__(self, locations):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1() failed")
+        self._names = {}  # Maps watch descriptor to the file names we care about
+        try:
+            for location in locations:
+                folder, name = os.path.split(os.path.abspath(location))
+                wd = libc.inotify_add_watch(  # pylint: disable=invalid-name
+                    self._fd, os.fsencode(folder),
+                    _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), "inotify_add_watch() failed", folder)
+                self._names.setdefault(wd, set()).add(os.fsencode(name))
+        except:  # pylint: disable=bare-except
+            os.close(self._fd)
+            raise
+
+    def wait(self, timeout):
+        # type: (float) -> bool
+        """Wait for at most timeout seconds. Return whether a watched file changed."""
+        changed = False
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        while readable:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError as ex:  # pylint: disable=invalid-name
+                if ex.errno == errno.EAGAIN:  # All events are drained
+                    break
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = _EVENT_HEADER.unpack_from(data, offset)  # pylint: disable=invalid-name
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                changed = changed or name in self._names.get(wd, ())
+        return changed
+
+    def close(self):
+        """Stop watching, and release the inotify instance"""
+        os.close(self._fd)
+
+
+class PersistenceWatcher(object):
+    """Calls back, in a daemon thread, whenever any of the locations changes.
+
+    It also calls back once right after it starts.
+    Exceptions raised by the callback are logged, and the watcher is then
+    no longer primed, until a later callback completes successfully.
+    The watcher stops by itself when the owner of the callback,
+    which is a bound method, is garbage collected.
+    """
+    def __init__(self, locations, callback, interval=_POLLING_INTERVAL):
+        """
+        :param list locations: The file paths to be watched.
+        :param callback: A bound method, to be called without any argument.
+        :param float interval:
+            The seconds between two callbacks, when inotify is unavailable.
+        """
+        self._locations = locations
+        self._callback = weakref.WeakMethod(callback)  # Do not keep the owner alive
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._primed = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        """Start the background thread, and return this watcher itself"""
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Ask the background thread to stop, without waiting for it.
+
+        It stops within an interval, and calls back no more.
+        """
+        self._stopped.set()
+        self._primed.clear()
+
+    def is_primed(self):
+        """Whether the latest callback has completed successfully"""
+        return self._primed.is_set()
+
+    def wait_until_primed(self, timeout=None):
+        """Wait for at most timeout seconds. Return whether it is primed."""
+        return self._primed.wait(timeout)
+
+    def _call_back(self):
+        # type: () -> bool
+        """Return False if the owner of the callback is gone"""
+        callback = self._callback()
+        if callback is None:
+            return False
+        try:
+            callback()
+            self._primed.set()
+        except Exception:  # pylint: disable=broad-except
+            self._primed.clear()  # What the owner has may be stale now
+            logger.debug("Watcher callback failed. Will retry next time.", exc_info=True)
+        return True
+
+    def _run(self):
+        inotify = None
+        if sys.platform.startswith("linux"):
+            try:
+                inotify = _Inotify(self._locations)
+            except (OSError, AttributeError):  # AttributeError means no such libc function
+                logger.debug("inotify is unavailable. Fall back to polling.", exc_info=True)
+        try:
+            while not self._stopped.is_set() and self._call_back():
+                if inotify:
+                    # Time out regularly, so that we can notice a stop() or a gone owner
+                    while not inotify.wait(self._interval):
+                        if self._stopped.is_set() or self._callback() is None:
+                            return
+                else:
+                    self._stopped.wait(self._interval)
+        finally:
+            if inotify:
+                inotify.close()
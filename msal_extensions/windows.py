@@ -63,11 +63,12 @@ class WindowsDataProtectionAgent(object):
             self._entropy_blob = DataBlob(len(entropy_utf8), blob_buffer)
 
     def protect(self, message):
-        # type: (str) -> bytes
-        """Encrypts a message.
+        # type: (Union[str, bytes]) -> bytes
+        """Encrypts a message, which is either a str or bytes.
         :return cipher text holding the original message."""
 
-        message = message.encode('utf-8')
+        if not isinstance(message, bytes):
+            message = message.encode('utf-8')
         message_buffer = ctypes.create_string_buffer(message, len(message))
         message_blob = DataBlob(len(message), message_buffer)
         result = DataBlob()
@@ -93,9 +94,10 @@ class WindowsDataProtectionAgent(object):
         err_code = _GET_LAST_ERROR()
         raise OSError(None, _err_description.get(err_code, ''), None, err_code)
 
-    def unprotect(self, cipher_text):
-        # type: (bytes) -> str
+    def unprotect(self, cipher_text, decode=True):
+        # type: (bytes, bool) -> Union[str, bytes]
         """Decrypts cipher text that is provided.
+        :param bool decode: Whether to decode the original message into str.
         :return The original message hidden in the cipher text."""
         ct_buffer = ctypes.create_string_buffer(cipher_text, len(cipher_text))
         ct_blob = DataBlob(len(cipher_text), ct_buffer)
@@ -116,7 +118,7 @@ class WindowsDataProtectionAgent(object):
                 ctypes.byref(result)
         ):
             try:
-                return result.raw().decode('utf-8')
+                return result.raw().decode('utf-8') if decode else result.raw()
             finally:
                 _LOCAL_FREE(result.pbData)
         err_code = _GET_LAST_ERROR()
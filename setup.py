@@ -28,6 +28,9 @@ setup(
         "portalocker": [
             'portalocker<4,>=1.4',
         ],
+        "cryptography": [  # For FilePersistenceWithSymmetricKey
+            'cryptography>=2.0',
+        ],
     },
     tests_require=['pytest'],
 )
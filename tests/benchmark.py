@@ -0,0 +1,182 @@
+"""
+Usage: python -m tests.benchmark [--sizes 10,100,1000] [--save FILE] [--compare FILE]
+
+This is a console application which measures the typical operations of a token cache,
+i.e. PersistedTokenCache.search(), modify() and _reload_if_necessary(),
+FilePersistence.save() and load(), as well as both CrossPlatLock implementations,
+across synthetic token caches of different sizes (i.e. number of entries).
+
+Each result is the median seconds per operation, among a few repetitions.
+Results can be saved as a baseline, which a later run can compare with,
+e.g. before and after an upgrade of this package, on a same machine.
+The run ends with exit code 1 when any operation is slower than the baseline
+by more than the tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import msal
+
+import msal_extensions
+from msal_extensions import FilePersistence, PersistedTokenCache
+from msal_extensions import filelock
+
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+_ENTRIES_PER_ACCOUNT = 5  # An account, its IdToken, RefreshToken and 2 AccessTokens
+
+
+def generate_cache(size):
+    # type: (int) -> dict
+    """Generate a cache of roughly size entries, in the format of msal.TokenCache"""
+    key_makers = msal.TokenCache().key_makers
+    cache = {}
+
+    def add(credential_type, entry):
+        cache.setdefault(credential_type, {})[
+            key_makers[credential_type](**entry)] = entry
+    for i in range(max(size // _ENTRIES_PER_ACCOUNT, 1)):
+        common = {
+            "home_account_id": "uid{}.utid{}".format(i, i % 7),
+            "environment": "login.microsoftonline.com",
+            "realm": "tenant{}".format(i % 7),
+            }
+        add("Account", dict(
+            common, local_account_id="uid{}".format(i),
+            username="user{}@contoso.com".format(i), authority_type="MSSTS"))
+        add("IdToken", dict(
+            common, credential_type="IdToken", client_id="client_id", secret="x" * 800))
+        add("RefreshToken", dict(
+            common, credential_type="RefreshToken", client_id="client_id",
+            target="", secret="x" * 700, last_modification_time="1700000000"))
+        for scope in ("s1", "s2"):
+            add("AccessToken", dict(
+                common, credential_type="AccessToken", client_id="client_id",
+                target=scope, secret="x" * 1500, token_type="Bearer",
+                cached_at="1700000000", expires_on="9999999999",
+                extended_expires_on="9999999999"))
+    add("AppMetadata", {
+        "client_id": "client_id", "environment": "login.microsoftonline.com"})
+    return cache
+
+
+def _measure(func, repeat, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def _lock_implementations():
+    implementations = {"filelock": filelock.CrossPlatLock}
+    try:
+        from msal_extensions import cache_lock  # pylint: disable=import-outside-toplevel
+        implementations["portalocker"] = cache_lock.CrossPlatLock
+    except ImportError:  # portalocker is an optional dependency
+        pass
+    return implementations
+
+
+def run(sizes, repeat=5):
+    # type: (list, int) -> dict
+    """Return a dict mapping each "operation@size" to its seconds per operation"""
+    results = {}
+    folder = tempfile.mkdtemp(prefix="msal_extensions_benchmark")
+    try:
+        for name, lock_class in _lock_implementations().items():
+            lock_location = os.path.join(folder, name + ".lockfile")
+
+            def acquire_and_release():
+                with lock_class(lock_location):  # pylint: disable=cell-var-from-loop
+                    pass
+            results["CrossPlatLock[{}]".format(name)] = _measure(
+                acquire_and_release, repeat * 10)
+        for size in sizes:
+            location = os.path.join(folder, "cache_{}.bin".format(size))
+            content = json.dumps(generate_cache(size), indent=4)
+            persistence = FilePersistence(location)
+            persistence.save(content)
+            cache = PersistedTokenCache(persistence)
+
+            def force_reload():
+                cache._snapshot.fingerprint = None  # pylint: disable=protected-access
+            some_query = {"home_account_id": "uid0.utid0", "client_id": "client_id"}
+            at = dict(next(iter(generate_cache(1)["AccessToken"].values())), target="s3")
+            for operation, func, setup in [
+                    ("FilePersistence.save", lambda: persistence.save(content), None),
+                    ("FilePersistence.load", persistence.load, None),
+                    ("PersistedTokenCache._reload_if_necessary",
+                        cache._reload_if_necessary,  # pylint: disable=protected-access
+                        force_reload),
+                    ("PersistedTokenCache.search", lambda: list(cache.search(
+                        "AccessToken", target=["s1"], query=some_query)), None),
+                    ("PersistedTokenCache.modify",
+                        lambda: cache.modify("AccessToken", at, at), None),
+                    ]:
+                results["{}@{}".format(operation, size)] = _measure(
+                    func, repeat, setup=setup)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # type: (dict, dict, float) -> list
+    """Print a comparison, and return the names of regressed operations"""
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        base = baseline.get(name)
+        if base:
+            ratio = seconds / base
+            regressed = ratio > 1 + tolerance
+            if regressed:
+                regressions.append(name)
+            print("{:<55} {:>12.6f}s {:>7.2f}x{}".format(
+                name, seconds, ratio, "  REGRESSED" if regressed else ""))
+        else:
+            print("{:<55} {:>12.6f}s {:>8}".format(name, seconds, "new"))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+        help="Comma-separated cache sizes. Defaults to %(default)s")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", help="Save the results into this baseline file")
+    parser.add_argument("--compare", help="Compare the results with this baseline file")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2,
+        help="A slowdown beyond this ratio is a regression. Defaults to %(default)s")
+    args = parser.parse_args(argv)
+    results = run([int(size) for size in args.sizes.split(",")], repeat=args.repeat)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as handle:  # pylint: disable=unspecified-encoding
+            baseline = json.load(handle)["results"]
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, "w") as handle:  # pylint: disable=unspecified-encoding
+            json.dump({
+                "msal_extensions": msal_extensions.__version__,
+                "python": sys.version,
+                "platform": platform.platform(),
+                "results": results,
+                }, handle, indent=4)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
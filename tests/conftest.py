@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from msal_extensions import FilePersistence
+
+
+@pytest.fixture
+def temp_location():
+    test_folder = tempfile.mkdtemp(prefix="test_msal_extensions")
+    yield os.path.join(test_folder, 'token_cache.bin')
+    shutil.rmtree(test_folder, ignore_errors=True)
+
+@pytest.fixture
+def build_refresh_token():
+    def build(home_account_id="uid.utid", secret="a refresh token"):
+        return {
+            "credential_type": "RefreshToken",
+            "secret": secret,
+            "home_account_id": home_account_id,
+            "environment": "login.microsoftonline.com",
+            "client_id": "my_client_id",
+            }
+    return build
+
+@pytest.fixture
+def build_access_token():
+    def build(client_id="fake_client_id", **kwargs):
+        return dict({
+            "credential_type": "AccessToken",
+            "secret": "an access token",
+            "home_account_id": "uid.utid",
+            "environment": "login.microsoftonline.com",
+            "client_id": client_id,
+            "realm": "contoso",
+            "target": "s1 s2",
+            "cached_at": "0",
+            "expires_on": "9999999999",
+            }, **kwargs)
+    return build
+
+class _UnusablePersistence(FilePersistence):
+    def load(self):
+        raise AssertionError("Should have been served without this persistence")
+    save = load
+
+@pytest.fixture
+def unusable_persistence():
+    """Builds a FilePersistence which fails the test once it is loaded or saved"""
+    return _UnusablePersistence
@@ -1,9 +1,9 @@
 import json
 import os
-import shutil
-import tempfile
 from unittest.mock import patch
 import sys
+import threading
+import time
 
 import msal
 import pytest
@@ -12,12 +12,6 @@ from msal_extensions import *
 from .http_client import MinimalResponse
 
 
-@pytest.fixture
-def temp_location():
-    test_folder = tempfile.mkdtemp(prefix="test_token_cache_roundtrip")
-    yield os.path.join(test_folder, 'token_cache.bin')
-    shutil.rmtree(test_folder, ignore_errors=True)
-
 def _test_token_cache_roundtrip(persistence):
     desired_scopes = ['https://graph.microsoft.com/.default']
     apps = [  # Multiple apps sharing same persistence
@@ -47,3 +41,343 @@ def test_file_not_found_error_is_not_raised():
     cache = PersistedTokenCache(persistence)
     # An exception raised here will fail the test case as it is supposed to be a NO-OP
     cache.find('')
+
+def test_cache_does_not_reload_its_own_write(temp_location, build_access_token):
+    persistence = FilePersistence(temp_location)
+    cache = PersistedTokenCache(persistence)
+    at = build_access_token()
+    cache.modify("AccessToken", at, at)
+    with patch.object(persistence, "load", side_effect=AssertionError("Reloaded")):
+        assert len(list(cache.search("AccessToken"))) == 1
+
+def test_cache_with_sqlite_persistence_uses_no_lock_file(temp_location, build_access_token):
+    writer = PersistedTokenCache(SqlitePersistence(temp_location))
+    reader = PersistedTokenCache(SqlitePersistence(temp_location))
+    with patch("msal_extensions.token_cache.CrossPlatLock",
+            side_effect=AssertionError("Should use transaction instead")):
+        for client_id in ("client_1", "client_2"):
+            at = build_access_token(client_id=client_id)
+            writer.modify("AccessToken", at, at)
+            assert len(list(reader.search("AccessToken", query={"client_id": client_id}))) == 1
+    assert len(list(reader.search("AccessToken"))) == 2
+
+@pytest.mark.parametrize("persistence_class", [SqlitePersistence, DirectoryPersistence])
+def test_cache_with_entry_persistence_moves_only_changed_entries(temp_location, persistence_class,
+        build_access_token):
+    writer = PersistedTokenCache(persistence_class(temp_location))
+    reader = PersistedTokenCache(persistence_class(temp_location))
+    for client_id in ("client_1", "client_2"):
+        at = build_access_token(client_id=client_id)
+        writer.modify("AccessToken", at, at)
+    assert len(list(reader.search("AccessToken"))) == 2
+    at = build_access_token(client_id="client_3")
+    with patch.object(writer._persistence, "save", side_effect=AssertionError("Rewrote all")
+            ), patch.object(writer._persistence, "put_entries",
+                wraps=writer._persistence.put_entries) as put_entries:
+        writer.modify("AccessToken", at, at)
+    assert len(put_entries.call_args[0][0]) == 1, "Should write only the changed entry"
+    with patch.object(reader._persistence, "load", side_effect=AssertionError("Reloaded all")):
+        assert len(list(reader.search("AccessToken"))) == 3
+        writer.modify("AccessToken", at, None)  # Removal
+        assert len(list(reader.search("AccessToken"))) == 2
+
+def test_cache_reloads_write_from_another_instance(temp_location, build_access_token):
+    persistence = FilePersistence(temp_location)
+    cache1 = PersistedTokenCache(persistence)
+    cache2 = PersistedTokenCache(FilePersistence(temp_location))
+    for client_id in ("client_1", "client_2"):  # Two writes likely within one mtime tick
+        at = build_access_token(client_id=client_id)
+        cache1.modify("AccessToken", at, at)
+        assert len(list(cache2.search("AccessToken"))) == len(list(
+            cache1.search("AccessToken"))), "cache2 should see the latest write"
+
+def test_search_retries_without_sleep_on_atomic_persistence(temp_location, build_access_token):
+    persistence = FilePersistence(temp_location, atomic=True)
+    cache = PersistedTokenCache(persistence)
+    at = build_access_token()
+    cache.modify("AccessToken", at, at)
+    reader = PersistedTokenCache(persistence)
+    with patch.object(persistence, "load", side_effect=[ValueError("Bad"), persistence.load()]
+            ), patch("time.sleep", side_effect=AssertionError("Should not sleep")):
+        assert len(list(reader.search("AccessToken"))) == 1
+
+def test_search_under_shared_read_lock_needs_no_retry(temp_location, build_access_token):
+    writer = PersistedTokenCache(FilePersistence(temp_location), shared_read_lock=True)
+    at = build_access_token()
+    writer.modify("AccessToken", at, at)
+    persistence = FilePersistence(temp_location)
+    reader = PersistedTokenCache(persistence, shared_read_lock=True)
+    assert len(list(reader.search("AccessToken"))) == 1
+    with patch.object(
+            persistence, "load", side_effect=ValueError("Genuine error")) as mocked_load:
+        writer.modify("AccessToken", at)  # Remove it, so that reader would reload
+        with pytest.raises(ValueError):
+            reader.search("AccessToken")
+    assert mocked_load.call_count == 1, "Should not retry"
+
+def test_instances_sharing_snapshot_reload_only_once(temp_location, build_access_token):
+    at = build_access_token()
+    PersistedTokenCache(FilePersistence(temp_location)).modify("AccessToken", at, at)
+    persistence = FilePersistence(temp_location)
+    caches = [
+        PersistedTokenCache(persistence, share_snapshot=True) for _ in range(3)]
+    with patch.object(persistence, "load", wraps=persistence.load) as mocked_load:
+        for cache in caches:
+            assert len(list(cache.search("AccessToken"))) == 1
+    assert mocked_load.call_count == 1, "Only the first search should reload"
+    another_at = build_access_token(client_id="another_client_id")
+    caches[0].modify("AccessToken", another_at, another_at)
+    assert len(list(caches[1].search("AccessToken"))) == 2, "Change should be visible"
+    assert len(list(PersistedTokenCache(  # But not shared by a non-opt-in instance
+        persistence)._cache)) == 0
+
+@pytest.mark.parametrize("share_snapshot", [False, True])
+def test_search_is_not_blocked_by_modify_waiting_for_lock_file(temp_location, share_snapshot,
+        build_access_token):
+    cache = PersistedTokenCache(
+        FilePersistence(temp_location), share_snapshot=share_snapshot)
+    at = build_access_token()
+    with CrossPlatLock(temp_location + ".lockfile"):  # As if held by another process
+        writer = threading.Thread(target=cache.modify, args=("AccessToken", at, at))
+        writer.start()
+        time.sleep(0.1)  # So that the writer is waiting for the lock file
+        start = time.time()
+        assert list(cache.search("AccessToken")) == []
+        assert time.time() - start < 0.5, "Search should not wait for the writer"
+    writer.join()
+    assert len(list(cache.search("AccessToken"))) == 1
+
+def test_group_commit_coalesces_concurrent_modifications(temp_location, build_access_token):
+    persistence = FilePersistence(temp_location)
+    cache = PersistedTokenCache(persistence, group_commit_window=0.1)
+    ats = [build_access_token(client_id="client_{}".format(i)) for i in range(8)]
+    with patch.object(persistence, "save", wraps=persistence.save) as mocked_save:
+        threads = [
+            threading.Thread(target=cache.modify, args=("AccessToken", at, at))
+            for at in ats]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert mocked_save.call_count < len(ats), "Some writes should have been coalesced"
+    assert len(list(PersistedTokenCache(
+        FilePersistence(temp_location)).search("AccessToken"))) == len(ats)
+
+@pytest.mark.skipif(
+    tuple(int(n) for n in msal.__version__.split(".")[:2]) < (1, 32),
+    reason="Requires MSAL Python 1.32+, whose search() removes expired access tokens")
+def test_group_commit_window_is_skipped_by_search_removing_expired_token(temp_location,
+        build_access_token):
+    expired_at = build_access_token(expires_on="0")
+    PersistedTokenCache(FilePersistence(temp_location)).modify(
+        "AccessToken", expired_at, expired_at)
+    cache = PersistedTokenCache(FilePersistence(temp_location), group_commit_window=1)
+    start = time.time()
+    assert list(cache.search("AccessToken")) == []
+    assert time.time() - start < 0.5, "Search should not wait for more changes to join"
+    assert list(PersistedTokenCache(
+        FilePersistence(temp_location)).search("AccessToken")) == []
+
+def test_group_commit_writes_once_per_add(temp_location):
+    persistence = FilePersistence(temp_location)
+    cache = PersistedTokenCache(persistence, group_commit_window=0)
+    with patch.object(persistence, "save", wraps=persistence.save) as mocked_save:
+        cache.add({
+            "client_id": "my_client_id",
+            "scope": ["s1"],
+            "token_endpoint": "https://login.microsoftonline.com/contoso/oauth2/v2.0/token",
+            "response": {
+                "access_token": "an access token",
+                "refresh_token": "a refresh token",
+                "expires_in": 3600,
+                },
+            })
+    assert mocked_save.call_count == 1
+    assert len(list(PersistedTokenCache(
+        FilePersistence(temp_location)).search("RefreshToken"))) == 1
+
+def test_group_commit_reports_error_to_caller(temp_location, build_access_token):
+    persistence = FilePersistence(temp_location)
+    cache = PersistedTokenCache(persistence, group_commit_window=0)
+    at = build_access_token()
+    with patch.object(persistence, "save", side_effect=IOError("Disk full")):
+        with pytest.raises(IOError):
+            cache.modify("AccessToken", at, at)
+
+def test_background_reload_keeps_search_free_of_io(temp_location, build_access_token):
+    writer = PersistedTokenCache(FilePersistence(temp_location))
+    persistence = FilePersistence(temp_location)
+    reader = PersistedTokenCache(persistence, background_reload=True)
+    assert reader._watcher.wait_until_primed(timeout=5)
+    at = build_access_token()
+    writer.modify("AccessToken", at, at)
+    for _ in range(50):  # Wait for the watcher to pick up the change
+        if reader._cache.get("AccessToken"):
+            break
+        time.sleep(0.1)
+    with patch.object(persistence, "fingerprint", side_effect=AssertionError("I/O")
+            ), patch.object(persistence, "load", side_effect=AssertionError("I/O")):
+        assert len(list(reader.search("AccessToken"))) == 1
+    reader.close()
+    assert reader._watcher is None
+
+def test_failed_background_reload_leaves_reload_to_search(temp_location, build_access_token):
+    writer = PersistedTokenCache(FilePersistence(temp_location))
+    persistence = FilePersistence(temp_location)
+    reader = PersistedTokenCache(persistence, background_reload=True)
+    watcher = reader._watcher
+    assert watcher.wait_until_primed(timeout=5)
+    at = build_access_token()
+    with patch.object(persistence, "load", side_effect=ValueError("A dirty read")):
+        writer.modify("AccessToken", at, at)
+        for _ in range(50):  # Wait for the watcher to pick up the change
+            if not watcher.is_primed():
+                break
+            time.sleep(0.1)
+        assert not watcher.is_primed(), "Snapshot should no longer be trusted"
+        assert reader._snapshot.fingerprint is None
+    assert len(list(reader.search("AccessToken"))) == 1
+    reader.close()
+
+def test_indexed_search_matches_unindexed_search(temp_location, build_access_token):
+    writer = PersistedTokenCache(FilePersistence(temp_location))
+    for i in range(20):
+        at = build_access_token(
+            client_id="client_{}".format(i % 4),
+            home_account_id="uid{}.utid".format(i % 5),
+            target="s{} common".format(i),
+            expires_on="0" if i == 7 else "9999999999")  # One of them is expired
+        writer.modify("AccessToken", at, at)
+    indexed = PersistedTokenCache(FilePersistence(temp_location), indexed=True)
+    plain = PersistedTokenCache(FilePersistence(temp_location))
+    def keys(cache, **kwargs):
+        return sorted(
+            cache.key_makers["AccessToken"](**at)
+            for at in cache.search("AccessToken", **kwargs))
+    for kwargs in [
+            {},
+            {"query": {"client_id": "client_3"}},
+            {"query": {"client_id": "client_3", "home_account_id": "uid3.utid"}},
+            {"query": {"client_id": "client_3"}, "target": ["s7"]},
+            {"target": ["common", "s12"]},
+            {"query": {"client_id": "no_such_client"}},
+            ]:
+        assert keys(indexed, **kwargs) == keys(plain, **kwargs), kwargs
+    assert keys(indexed, query={"environment": "LOGIN.microsoftonline.com"}) == keys(
+        plain, query={"environment": "login.microsoftonline.com"}
+        ), "Environment shall be case-insensitive, same as MSAL Python 1.34+"
+    at = build_access_token(client_id="client_3", target="s100")
+    indexed.modify("AccessToken", at, at)  # Index shall be updated incrementally
+    assert len(keys(indexed, query={"client_id": "client_3"}, target=["s100"])) == 1
+    indexed.modify("AccessToken", at)
+    assert keys(indexed, query={"client_id": "client_3"}, target=["s100"]) == []
+
+def test_index_is_updated_under_in_process_lock(temp_location, build_access_token):
+    cache = PersistedTokenCache(FilePersistence(temp_location), indexed=True)
+    assert list(cache.search("AccessToken")) == []  # So that the index is built
+    index = cache._snapshot.index
+    update, owned = index.update, []
+    def update_and_check(*args):
+        owned.append(cache._lock._is_owned())
+        return update(*args)
+    with patch.object(index, "update", side_effect=update_and_check):
+        at = build_access_token()
+        cache.modify("AccessToken", at, at)
+    assert owned == [True]
+
+def test_modify_purges_expired_access_tokens_after_grace(temp_location, build_access_token):
+    persistence = FilePersistence(temp_location)
+    cache = PersistedTokenCache(persistence, purge_expired_after=60)
+    now = int(time.time())
+    long_expired = build_access_token(client_id="a", expires_on=str(now - 3600))
+    just_expired = build_access_token(client_id="b", expires_on=str(now - 1))
+    for at in (long_expired, just_expired):
+        PersistedTokenCache(persistence).modify("AccessToken", at, at)
+    at = build_access_token(client_id="c")
+    cache.modify("AccessToken", at, at)
+    assert sorted(json.loads(persistence.load())["AccessToken"]) == sorted(
+        cache.key_makers["AccessToken"](**at) for at in (just_expired, at))
+
+def test_compact_removes_expired_access_tokens(temp_location, build_access_token):
+    persistence = FilePersistence(temp_location)
+    cache = PersistedTokenCache(persistence)
+    at = build_access_token(expires_on=str(int(time.time()) - 1))
+    cache.modify("AccessToken", at, at)
+    assert cache.compact() == 1
+    assert json.loads(persistence.load())["AccessToken"] == {}
+    assert cache.compact() == 0
+
+def test_modify_evicts_least_recently_used_entries_beyond_cap(temp_location, build_access_token):
+    persistence = FilePersistence(temp_location)
+    cache = PersistedTokenCache(persistence, max_entries=3)
+    ats = [build_access_token(client_id="client_{}".format(i)) for i in range(4)]
+    for at in ats[:3]:
+        cache.modify("AccessToken", at, at)
+    assert list(cache.search("AccessToken", query={"client_id": "client_0"}))  # Used
+    cache.modify("AccessToken", ats[3], ats[3])  # Beyond the cap
+    remaining = sorted(
+        at["client_id"] for at in json.loads(persistence.load())["AccessToken"].values())
+    assert remaining == ["client_0", "client_2", "client_3"], "client_1 is the LRU"
+
+def test_modify_evicts_entries_beyond_byte_cap(temp_location, build_access_token):
+    persistence = FilePersistence(temp_location)
+    cache = PersistedTokenCache(persistence, max_bytes=2000)
+    for i in range(20):
+        at = build_access_token(client_id="client_{}".format(i))
+        cache.modify("AccessToken", at, at)
+    assert 0 < len(json.loads(persistence.load())["AccessToken"]) < 20
+    assert os.path.getsize(temp_location) < 2000 * 1.5
+
+def test_lazy_load_deserializes_only_the_searched_credential_type(temp_location,
+        build_access_token):
+    writer = PersistedTokenCache(FilePersistence(temp_location))
+    at = build_access_token()
+    writer.modify("AccessToken", at, at)
+    rt = dict(at, credential_type="RefreshToken", secret="a refresh token")
+    writer.modify("RefreshToken", rt, rt)
+    reader = PersistedTokenCache(FilePersistence(temp_location), lazy_load=True)
+    assert len(list(reader.search("AccessToken"))) == 1
+    assert "RefreshToken" not in reader._cache, "Should not be deserialized yet"
+    assert len(list(reader.search("RefreshToken"))) == 1
+    another_at = build_access_token(client_id="another_client_id")
+    reader.modify("AccessToken", another_at, another_at)
+    assert json.loads(reader.serialize()) == json.loads(FilePersistence(temp_location).load())
+    assert len(json.loads(FilePersistence(temp_location).load())["AccessToken"]) == 2
+
+def test_lazy_load_falls_back_to_full_deserialization(temp_location, build_access_token):
+    at = build_access_token()
+    FilePersistence(temp_location).save(json.dumps({  # A compact layout
+        "AccessToken": {"the_key": at}}))
+    reader = PersistedTokenCache(FilePersistence(temp_location), lazy_load=True)
+    assert len(list(reader.search("AccessToken"))) == 1
+
+def test_observer_is_notified_of_each_phase(temp_location, build_access_token):
+    events = []
+    def observer(phase, seconds, **details):
+        assert seconds >= 0
+        events.append((phase, details))
+    persistence = FilePersistence(temp_location)
+    writer = PersistedTokenCache(persistence, observer=observer)
+    at = build_access_token()
+    writer.modify("AccessToken", at, at)
+    assert [phase for phase, _ in events] == ["lock_wait", "serialize", "save"]
+    assert events[0][1] == {"lock": "exclusive"}
+    assert events[1][1]["bytes"] == events[2][1]["bytes"] == os.path.getsize(temp_location)
+    del events[:]
+    reader = PersistedTokenCache(persistence, observer=observer)
+    with patch.object(persistence, "load", side_effect=[ValueError("Bad"), persistence.load()]
+            ), patch("time.sleep"):
+        assert len(list(reader.search("AccessToken"))) == 1
+    assert [phase for phase, _ in events] == ["search_retry", "load", "deserialize"]
+    assert events[0][1]["attempt"] == 1
+
+def test_observer_failure_does_not_break_cache(temp_location, build_access_token):
+    cache = PersistedTokenCache(
+        FilePersistence(temp_location), observer=lambda *args, **kwargs: 1 / 0)
+    at = build_access_token()
+    cache.modify("AccessToken", at, at)
+    assert len(list(cache.search("AccessToken"))) == 1
+
+def test_unknown_option_is_rejected(temp_location):
+    with pytest.raises(TypeError):
+        PersistedTokenCache(FilePersistence(temp_location), jounral=True)  # A typo
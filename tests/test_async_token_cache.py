@@ -0,0 +1,75 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from msal_extensions import (
+    FilePersistence, PersistedTokenCache, CrossPlatLock, LockPolicy, LockError,
+    AsyncPersistedTokenCache, AsyncCrossPlatLock)
+
+
+def test_async_and_sync_caches_interoperate(temp_location, build_refresh_token):
+    sync_cache = PersistedTokenCache(FilePersistence(temp_location))
+    async_cache = AsyncPersistedTokenCache(FilePersistence(temp_location))
+
+    async def run():
+        rt = build_refresh_token("alice")
+        await async_cache.modify("RefreshToken", rt, rt)
+        assert len(list(sync_cache.search("RefreshToken"))) == 1
+        rt = build_refresh_token("bob")
+        sync_cache.modify("RefreshToken", rt, rt)
+        return await async_cache.search("RefreshToken")
+    try:
+        assert len(asyncio.run(run())) == 2
+    finally:
+        async_cache.close()
+
+def test_async_lock_waits_without_blocking_event_loop(temp_location):
+    lock_location = temp_location + ".lockfile"
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    async def run():
+        ticker = asyncio.ensure_future(tick())
+        with CrossPlatLock(lock_location):  # Held by someone else
+            with pytest.raises(LockError):
+                async with AsyncCrossPlatLock(
+                        lock_location, policy=LockPolicy(timeout=0.3, interval=0.05)):
+                    pass
+        async with AsyncCrossPlatLock(lock_location):  # Now it is available
+            assert os.path.exists(lock_location)
+        ticker.cancel()
+    asyncio.run(run())
+    assert len(ticks) > 10, "Event loop should keep running while we wait for the lock"
+    assert not os.path.exists(lock_location)
+
+def test_async_cache_does_not_block_event_loop_while_waiting_for_lock(temp_location,
+        build_refresh_token):
+    async_cache = AsyncPersistedTokenCache(FilePersistence(temp_location))
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    async def run():
+        ticker = asyncio.ensure_future(tick())
+        rt = build_refresh_token("alice")
+        with CrossPlatLock(temp_location + ".lockfile"):  # Held by someone else
+            modification = asyncio.ensure_future(async_cache.modify("RefreshToken", rt, rt))
+            await asyncio.sleep(0.3)
+            assert not modification.done(), "It should be waiting for the lock"
+        await modification
+        ticker.cancel()
+        return await async_cache.search("RefreshToken")
+    try:
+        assert len(asyncio.run(run())) == 1
+    finally:
+        async_cache.close()
+    assert len(ticks) > 10, "Event loop should keep running while modify() waits"
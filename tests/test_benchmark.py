@@ -0,0 +1,18 @@
+import json
+
+from .benchmark import generate_cache, run, compare, main
+
+
+def test_generate_cache_of_requested_size():
+    cache = generate_cache(1000)
+    assert abs(sum(len(entries) for entries in cache.values()) - 1000) <= 1
+
+def test_benchmark_runs_and_compares_with_baseline(tmpdir):
+    results = run([10], repeat=1)
+    assert "PersistedTokenCache.search@10" in results
+    assert compare(results, {name: s * 10 for name, s in results.items()}, 0.2) == []
+    assert compare(results, {name: s / 10 for name, s in results.items()}, 0.2)
+    baseline = str(tmpdir.join("baseline.json"))
+    main(["--sizes", "10", "--repeat", "1", "--save", baseline])
+    with open(baseline) as handle:
+        assert json.load(handle)["results"]
@@ -1,5 +1,13 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
 import pytest
-from msal_extensions import CrossPlatLock
+from msal_extensions import CrossPlatLock, LockPolicy
+from msal_extensions import filelock
 
 
 def test_ensure_file_deleted():
@@ -17,3 +25,125 @@ def test_ensure_file_deleted():
     with pytest.raises(FileNotFoundError):
         with open(lockfile):
             pass
+
+
+def _lock_implementations():
+    yield filelock.CrossPlatLock
+    try:
+        from msal_extensions import cache_lock
+    except ImportError:  # portalocker is optional
+        return
+    yield cache_lock.CrossPlatLock
+
+
+@pytest.mark.skipif(
+    sys.platform.startswith('win'),
+    reason="Waiters on Windows still poll")
+@pytest.mark.parametrize("lock_class", list(_lock_implementations()))
+def test_waiter_wakes_up_right_after_release(tmpdir, lock_class):
+    lockfile = str(tmpdir.join("test.lockfile"))
+    hold_time = 0.35  # Polling every 0.25s would not acquire it until 0.5s
+    acquired = threading.Event()
+
+    def hold():
+        with lock_class(lockfile):
+            acquired.set()
+            time.sleep(hold_time)
+    holder = threading.Thread(target=hold)
+    holder.start()
+    acquired.wait()
+    start = time.time()
+    with lock_class(lockfile):
+        elapsed = time.time() - start
+    holder.join()
+    assert elapsed < hold_time + 0.1, "Waiter should not wait for next polling interval"
+
+
+def _dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+@pytest.mark.parametrize("lock_class", list(_lock_implementations()))
+def test_stale_lock_left_by_dead_process_is_broken_right_away(tmpdir, lock_class):
+    lockfile = str(tmpdir.join("test.lockfile"))
+    with open(lockfile, "w") as handle:  # As if its holder crashed
+        handle.write("{} crashed.py\n{}".format(_dead_pid(), socket.gethostname()))
+    with lock_class(lockfile, policy=LockPolicy(timeout=0, raise_on_timeout=True)):
+        pass
+    assert not os.path.exists(lockfile)
+
+@pytest.mark.parametrize("content", [
+    "{} alive.py\n{}".format(os.getpid(), socket.gethostname()),  # Holder is alive
+    "{} crashed.py\nanother_host".format(_dead_pid()),  # Can not tell from here
+    "{} older_version.py".format(_dead_pid()),  # Without a hostname
+    "",  # Its holder is yet to write
+    ])
+def test_lock_is_not_broken_unless_surely_stale(tmpdir, content):
+    lockfile = str(tmpdir.join("test.lockfile"))
+    with open(lockfile, "w") as handle:
+        handle.write(content)
+    assert not filelock._break_stale_lock(lockfile)
+    assert os.path.exists(lockfile)
+
+
+def _read_write_lock_implementations():
+    yield filelock.CrossPlatReadWriteLock
+    try:
+        from msal_extensions import cache_lock
+    except ImportError:  # portalocker is optional
+        return
+    yield cache_lock.CrossPlatReadWriteLock
+
+
+@pytest.mark.skipif(
+    sys.platform.startswith('win'),
+    reason="Shared lock fallback on Windows is exclusive")
+@pytest.mark.parametrize("lock_class", list(_read_write_lock_implementations()))
+def test_readers_share_a_read_write_lock(tmpdir, lock_class):
+    lockfile = str(tmpdir.join("test.lockfile.rw"))
+    with lock_class(lockfile, shared=True):
+        with lock_class(lockfile, shared=True):
+            pass  # Would otherwise time out
+
+
+@pytest.mark.parametrize("lock_class", list(_read_write_lock_implementations()))
+def test_writer_excludes_readers(tmpdir, lock_class):
+    lockfile = str(tmpdir.join("test.lockfile.rw"))
+    hold_time = 0.3
+    acquired = threading.Event()
+
+    def write():
+        with lock_class(lockfile):
+            acquired.set()
+            time.sleep(hold_time)
+    writer = threading.Thread(target=write)
+    writer.start()
+    acquired.wait()
+    start = time.time()
+    with lock_class(lockfile, shared=True):
+        elapsed = time.time() - start
+    writer.join()
+    assert hold_time - 0.1 < elapsed, "Reader should wait for the writer"
+
+
+@pytest.mark.skipif(
+    sys.platform.startswith('win'),
+    reason="Waiters on Windows poll without helper threads")
+@pytest.mark.parametrize("lock_class", list(_read_write_lock_implementations()))
+def test_timed_out_waiters_do_not_pile_up_helper_threads(tmpdir, lock_class):
+    lockfile = str(tmpdir.join("test.lockfile.rw"))
+    lock_error = sys.modules[lock_class.__module__].LockError
+    with lock_class(lockfile):
+        threads_before = threading.active_count()
+        for _ in range(5):
+            with pytest.raises(lock_error):
+                with lock_class(
+                        lockfile, shared=True,
+                        policy=LockPolicy(timeout=0.05, raise_on_timeout=True)):
+                    pass
+        assert threading.active_count() <= threads_before + 1, (
+            "At most one helper thread shall be pending on a same lock file")
+    start = time.time()
+    with lock_class(lockfile, shared=True):  # Still acquirable after release
+        assert time.time() - start < 1
@@ -0,0 +1,90 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+import pytest
+
+from msal_extensions import (
+    FilePersistence, PersistedTokenCache, TokenCacheDaemon, DaemonPersistence)
+
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(socket, "AF_UNIX"), reason="Requires Unix domain socket")
+
+
+@pytest.fixture
+def temp_location():
+    # A short path, because a socket path is limited to roughly 100 characters
+    test_folder = tempfile.mkdtemp(prefix="daemon", dir="/tmp")
+    yield os.path.join(test_folder, 'token_cache.bin')
+    shutil.rmtree(test_folder, ignore_errors=True)
+
+@pytest.fixture
+def daemon(temp_location):
+    daemon = TokenCacheDaemon(FilePersistence(temp_location))
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    yield daemon
+    daemon.shutdown()
+    daemon.server_close()
+    thread.join()
+
+def test_token_cache_is_served_by_daemon(daemon, temp_location,
+        build_refresh_token, unusable_persistence):
+    cache = PersistedTokenCache(DaemonPersistence(unusable_persistence(temp_location)))
+    rt = build_refresh_token()
+    cache.modify("RefreshToken", rt, rt)
+    assert list(cache.search("RefreshToken", query={"client_id": "my_client_id"})) == [rt]
+    key = cache.key_makers["RefreshToken"](**rt)
+    assert cache._get("RefreshToken", key) == rt
+    assert list(PersistedTokenCache(FilePersistence(temp_location)).search(
+        "RefreshToken")) == [rt], "The daemon should persist it"
+    cache._persistence.close()
+
+
+def test_daemon_sees_changes_made_without_it(daemon, temp_location, build_refresh_token):
+    client = PersistedTokenCache(DaemonPersistence(FilePersistence(temp_location)))
+    assert list(client.search("RefreshToken")) == []
+    rt = build_refresh_token()
+    PersistedTokenCache(FilePersistence(temp_location)).modify("RefreshToken", rt, rt)
+    assert list(client.search("RefreshToken")) == [rt]
+    client._persistence.close()
+
+
+def test_client_falls_back_to_file_when_daemon_is_unreachable(temp_location, build_refresh_token):
+    cache = PersistedTokenCache(DaemonPersistence(FilePersistence(temp_location)))
+    rt = build_refresh_token()
+    cache.modify("RefreshToken", rt, rt)
+    assert list(cache.search("RefreshToken")) == [rt]
+    assert list(PersistedTokenCache(FilePersistence(temp_location)).search(
+        "RefreshToken")) == [rt]
+
+
+def test_client_reconnects_after_daemon_restarted(temp_location, build_refresh_token):
+    client = PersistedTokenCache(DaemonPersistence(FilePersistence(temp_location)))
+    for secret in ["first", "second"]:
+        daemon = TokenCacheDaemon(FilePersistence(temp_location))
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.start()
+        try:
+            rt = build_refresh_token(secret=secret)
+            client.modify("RefreshToken", rt, rt)
+            assert [rt["secret"] for rt in client.search("RefreshToken")] == [secret]
+        finally:
+            daemon.shutdown()
+            daemon.server_close()
+            thread.join()
+    client._persistence.close()
+
+
+def test_socket_is_only_accessible_by_current_user(daemon):
+    assert os.stat(daemon.server_address).st_mode & 0o777 == 0o600
+
+
+def test_daemon_error_keeps_its_type(daemon, temp_location):
+    persistence = DaemonPersistence(FilePersistence(temp_location))
+    with pytest.raises(ValueError, match="Unknown op"):
+        persistence._call("unknown")
+    persistence.close()
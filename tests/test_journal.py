@@ -0,0 +1,97 @@
+from unittest.mock import patch
+
+import pytest
+
+from msal_extensions import FilePersistence, PersistedTokenCache
+from msal_extensions.journal import Journal
+from msal_extensions import token_cache
+
+
+def test_journal_reads_only_new_records(temp_location):
+    journal = Journal(temp_location + ".journal")
+    assert journal.read() == ([], (None, 0))
+    position = journal.reset()
+    position = journal.append([{"n": 1}], position)
+    assert journal.read() == ([{"n": 1}], position)
+    journal.append([{"n": 2}, {"n": 3}], position)
+    records, _ = journal.read(position)
+    assert records == [{"n": 2}, {"n": 3}]
+
+def test_journal_reads_from_beginning_after_reset(temp_location):
+    journal = Journal(temp_location + ".journal")
+    position = journal.append([{"n": 1}], journal.reset())
+    new_position = journal.append([{"n": 2}], journal.reset())
+    assert journal.read(position) == ([{"n": 2}], new_position)
+
+def test_journal_ignores_incomplete_record(temp_location):
+    journal = Journal(temp_location + ".journal")
+    position = journal.reset()
+    with open(journal.get_location(), "ab") as handle:
+        handle.write(b'{"n": 1')  # As if it is still being written
+    assert journal.read() == ([], position)
+
+def test_journal_discards_torn_record_when_appending(temp_location):
+    journal = Journal(temp_location + ".journal")
+    position = journal.append([{"n": 1}], journal.reset())
+    with open(journal.get_location(), "ab") as handle:
+        handle.write(b'{"n": 2\n{"n": 3}\n')  # As if a writer crashed, then another appended
+    assert journal.read() == ([{"n": 1}], position)
+    position = journal.append([{"n": 4}], position)
+    assert journal.read() == ([{"n": 1}, {"n": 4}], position)
+
+def test_journal_mode_survives_writer_crashed_in_the_middle(
+        temp_location, build_refresh_token):
+    writer = PersistedTokenCache(FilePersistence(temp_location), journal=True)
+    rt = build_refresh_token("alice")
+    writer.modify("RefreshToken", rt, rt)
+    with open(temp_location + ".journal", "ab") as handle:
+        handle.write(b'{"credential_type":"Refre')  # As if a writer crashed
+    rt = build_refresh_token("bob")
+    writer.modify("RefreshToken", rt, rt)
+    reader = PersistedTokenCache(FilePersistence(temp_location), journal=True)
+    assert sorted(rt["home_account_id"] for rt in reader.search("RefreshToken")) == [
+        "alice", "bob"]
+
+def test_journal_mode_appends_instead_of_rewriting_snapshot(temp_location, build_refresh_token):
+    persistence = FilePersistence(temp_location)
+    writer = PersistedTokenCache(persistence, journal=True)
+    reader = PersistedTokenCache(FilePersistence(temp_location), journal=True)
+    with patch.object(persistence, "save", side_effect=AssertionError("Rewritten")):
+        for uid in ("alice", "bob"):
+            rt = build_refresh_token(uid)
+            writer.modify("RefreshToken", rt, rt)
+        writer.modify("RefreshToken", build_refresh_token("alice"))  # Removal
+    assert [rt["home_account_id"] for rt in reader.search("RefreshToken")] == ["bob"]
+
+def test_journal_is_compacted_into_snapshot(temp_location, build_refresh_token):
+    writer = PersistedTokenCache(FilePersistence(temp_location), journal=True)
+    reader = PersistedTokenCache(FilePersistence(temp_location), journal=True)
+    assert list(reader.search("RefreshToken")) == []
+    for uid in ("alice", "bob"):
+        rt = build_refresh_token(uid)
+        writer.modify("RefreshToken", rt, rt)
+    assert len(list(reader.search("RefreshToken"))) == 2
+    with patch.object(token_cache, "_JOURNAL_COMPACTION_THRESHOLD", 0), patch.object(
+            writer._snapshot, "size", 0):  # So that next modify() triggers compaction
+        rt = build_refresh_token("carol")
+        writer.modify("RefreshToken", rt, rt)
+    assert Journal(temp_location + ".journal").read()[0] == [], "Should be compacted"
+    assert len(list(reader.search("RefreshToken"))) == 3
+    assert len(list(PersistedTokenCache(  # A non-journal reader sees them too
+        FilePersistence(temp_location)).search("RefreshToken"))) == 3
+
+def test_journal_mode_is_not_for_encrypted_persistence(temp_location):
+    persistence = FilePersistence(temp_location)
+    persistence.is_encrypted = True  # Pretend
+    with pytest.raises(ValueError):
+        PersistedTokenCache(persistence, journal=True)
+
+def test_compact_folds_journal_into_snapshot(temp_location, build_refresh_token):
+    writer = PersistedTokenCache(FilePersistence(temp_location), journal=True)
+    rt = build_refresh_token("alice")
+    writer.modify("RefreshToken", rt, rt)
+    assert Journal(temp_location + ".journal").read()[0], "Change should be journaled"
+    assert writer.compact() == 0
+    assert Journal(temp_location + ".journal").read()[0] == [], "Should be compacted"
+    assert len(list(PersistedTokenCache(
+        FilePersistence(temp_location)).search("RefreshToken"))) == 1
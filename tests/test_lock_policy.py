@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from msal_extensions import LockPolicy, LockError
+from msal_extensions import filelock
+
+
+def _lock_implementations():
+    yield filelock.CrossPlatLock
+    try:
+        from msal_extensions import cache_lock
+    except ImportError:  # portalocker is optional
+        return
+    yield cache_lock.CrossPlatLock
+
+
+def test_default_policy_retries_every_quarter_second():
+    policy = LockPolicy()
+    assert [policy.get_interval(attempt, 0) for attempt in range(3)] == [0.25] * 3
+
+def test_exponential_backoff_is_capped():
+    policy = LockPolicy(interval=0.1, backoff=2, max_interval=0.5)
+    assert [policy.get_interval(attempt, 0) for attempt in range(4)] == pytest.approx(
+        [0.1, 0.2, 0.4, 0.5])
+
+def test_jitter_stays_within_range():
+    policy = LockPolicy(interval=1, jitter=0.5)
+    for _ in range(100):
+        assert 0.5 <= policy.get_interval(0, 0) <= 1.5
+
+def test_adaptive_policy_waits_for_expected_remaining_hold_time():
+    policy = LockPolicy(adaptive=True)
+    assert policy.get_interval(0, 0) == 0.25, "Nothing learnt yet"
+    policy.record_hold_time(1)
+    assert policy.get_interval(0, 0.4) == pytest.approx(0.6)
+    assert policy.get_interval(0, 2) == 0.25, "Overdue holder falls back to polling"
+    assert policy.get_interval(0, None) == 0, "Lock file is gone"
+
+def test_non_adaptive_policy_learns_nothing():
+    policy = LockPolicy()
+    policy.record_hold_time(1)
+    assert policy.get_interval(0, 0) == 0.25
+
+def test_non_adaptive_policy_ignores_lock_file(tmpdir):
+    lockfile = tmpdir.join("test.lockfile")
+    lockfile.write("")
+    assert LockPolicy().next_interval(0, str(lockfile)) == (0.25, None)
+    assert LockPolicy(adaptive=True).next_interval(0, str(lockfile))[1] is not None
+
+@pytest.mark.parametrize("lock_class", list(_lock_implementations()))
+def test_fail_fast_policy(tmpdir, lock_class):
+    lockfile = tmpdir.join("test.lockfile")
+    lockfile.write("A stale lock file left behind by an old version")
+    start = time.time()
+    with pytest.raises(LockError if lock_class is not filelock.CrossPlatLock
+            else filelock.LockError):
+        with lock_class(str(lockfile), policy=LockPolicy(
+                timeout=0.1, raise_on_timeout=True)):
+            pass
+    assert time.time() - start < 1
@@ -1,12 +1,20 @@
+import base64
+import json
 import os
 import sys
 import shutil
+import subprocess
 import tempfile
 import logging
+from unittest.mock import patch
 
 import pytest
 
 from msal_extensions.persistence import *
+from msal_extensions.filelock import LockError
+from msal_extensions.symmetric_persistence import FilePersistenceWithSymmetricKey, _parse_key
+from msal_extensions.sqlite_persistence import SqlitePersistence
+from msal_extensions.directory_persistence import DirectoryPersistence
 
 
 def _is_env_var_defined(env_var):
@@ -37,12 +45,170 @@ def _test_nonexistent_persistence(persistence):
         persistence.load()
     with pytest.raises(PersistenceNotFound):
         persistence.time_last_modified()
+    with pytest.raises(PersistenceNotFound):
+        persistence.fingerprint()
 
 def test_file_persistence(temp_location):
     _test_persistence_roundtrip(FilePersistence(temp_location))
 
+def test_file_persistence_fingerprint_changes_on_each_save(temp_location):
+    persistence = FilePersistence(temp_location)
+    persistence.save('foo')
+    fingerprint = persistence.fingerprint()
+    assert fingerprint == persistence.fingerprint(), "Should be stable when unchanged"
+    persistence.save('foobar')  # Very likely within a same mtime tick
+    assert fingerprint != persistence.fingerprint()
+
+def test_atomic_file_persistence(temp_location):
+    persistence = FilePersistence(temp_location, atomic=True)
+    assert persistence.is_atomic
+    _test_persistence_roundtrip(persistence)
+    assert os.listdir(os.path.dirname(temp_location)) == [
+        os.path.basename(temp_location)], "Temp file should not be left behind"
+
+def test_atomic_file_persistence_reports_fallback_to_in_place_write(temp_location):
+    persistence = FilePersistence(temp_location, atomic=True)
+    with patch("os.replace", side_effect=PermissionError("As if a reader holds it")):
+        persistence.save('arbitrary content')
+    assert not persistence.is_atomic, "A reader shall no longer rely on atomic writes"
+    assert persistence.load() == 'arbitrary content'
+    assert os.listdir(os.path.dirname(temp_location)) == [
+        os.path.basename(temp_location)], "Temp file should not be left behind"
+
+@pytest.mark.skipif(
+    sys.platform.startswith('win'),
+    reason="Windows can not rename a file which is being read")
+def test_atomic_file_persistence_does_not_tear_concurrent_read(temp_location):
+    persistence = FilePersistence(temp_location, atomic=True)
+    persistence.save('arbitrary content')
+    with open(temp_location) as handle:  # Kept open, as if by a concurrent reader
+        persistence.save('new content')
+        assert handle.read() == 'arbitrary content', "Reader should not see torn write"
+    assert persistence.load() == 'new content'
+
+def test_memory_mapped_file_persistence(temp_location):
+    persistence = FilePersistence(temp_location, memory_map=True)
+    assert persistence.is_atomic, "A mapped file shall never be truncated in place"
+    _test_persistence_roundtrip(persistence)
+    persistence.save('')
+    assert persistence.load() == '', "An empty file can not be mapped, yet should load"
+    persistence.save('caf\u00e9')
+    assert persistence.load() == FilePersistence(temp_location).load() == 'caf\u00e9', (
+        "Both load paths shall use a same encoding")
+
+@pytest.mark.parametrize("compression", ["zlib", "lzma"])
+def test_compressed_file_persistence(temp_location, compression):
+    payload = '{"AccessToken": {}}' * 100
+    FilePersistence(temp_location, compression=compression).save(payload)
+    assert os.path.getsize(temp_location) < len(payload)
+    for reader in (  # All detect compression, regardless of their own settings
+            FilePersistence(temp_location),
+            FilePersistence(temp_location, memory_map=True),
+            FilePersistence(temp_location, compression="zlib"),
+            ):
+        assert reader.load() == payload
+
+def test_compressed_file_persistence_loads_legacy_content(temp_location):
+    FilePersistence(temp_location).save('arbitrary content')
+    assert FilePersistence(temp_location, compression="lzma").load() == 'arbitrary content'
+
+def test_unknown_compression_is_rejected(temp_location):
+    with pytest.raises(ValueError):
+        FilePersistence(temp_location, compression="zip")
+
+def test_package_is_importable_without_optional_lzma():
+    subprocess.run([sys.executable, "-c", (
+        "import sys; sys.modules['lzma'] = None; import msal_extensions; "
+        "msal_extensions.FilePersistence('unused', compression='zlib')")], check=True)
+
+def test_package_is_importable_without_optional_sqlite3():
+    subprocess.run([sys.executable, "-c", (
+        "import sys; sys.modules['sqlite3'] = None; import msal_extensions")], check=True)
+
+def test_sqlite_persistence(temp_location):
+    persistence = SqlitePersistence(temp_location)
+    cache = {"AccessToken": {"at1": {"secret": "1"}, "at2": {"secret": "2"}}}
+    persistence.save(json.dumps(cache))
+    assert json.loads(persistence.load()) == cache
+    fingerprint = persistence.fingerprint()
+    cache["AccessToken"]["at2"]["secret"] = "changed"
+    del cache["AccessToken"]["at1"]
+    with patch.object(  # Spy on the writes
+            persistence, "_connection", wraps=persistence._connection) as connection:
+        SqlitePersistence(temp_location).save(json.dumps(cache))  # By another instance
+        persistence.save(json.dumps(cache))  # Nothing changed since then
+    assert persistence.fingerprint() != fingerprint
+    assert json.loads(persistence.load()) == cache
+    assert not [c for c in connection.executemany.call_args_list if c.args[1]], (
+        "Should write no row when no entry changed")
+
+def test_nonexistent_sqlite_persistence(temp_location):
+    with pytest.raises(PersistenceNotFound):
+        SqlitePersistence(temp_location).load()
+    with pytest.raises(PersistenceNotFound):
+        SqlitePersistence(temp_location).fingerprint()
+
+def test_sqlite_persistence_readers_are_not_blocked_by_writer(temp_location):
+    writer = SqlitePersistence(temp_location, timeout=0)
+    writer.save('{"AccessToken": {"at": {"secret": "old"}}}')
+    with writer.transaction():
+        writer.save('{"AccessToken": {"at": {"secret": "new"}}}')
+        reader = SqlitePersistence(temp_location, timeout=0)
+        assert json.loads(reader.load()) == {"AccessToken": {"at": {"secret": "old"}}}, (
+            "Reader should see old data, without waiting")
+        with pytest.raises(LockError):
+            with reader.transaction():  # But another writer is excluded
+                pass
+    assert json.loads(reader.load()) == {"AccessToken": {"at": {"secret": "new"}}}
+
+def _catch_up(persistence, version):
+    new_version, changes = persistence.changed_since(version)
+    return (new_version, changes) if changes is not None else persistence.changed_since(None)
+
+@pytest.mark.parametrize("persistence_class", [SqlitePersistence, DirectoryPersistence])
+def test_entry_persistence_tracks_changes(temp_location, persistence_class):
+    writer = persistence_class(temp_location)
+    reader = persistence_class(temp_location)
+    version, changes = reader.changed_since(None)
+    assert changes == []
+    writer.put_entries([
+        ("AccessToken", "at1", {"secret": "1"}), ("AccessToken", "at2", {"secret": "2"})])
+    version, changes = _catch_up(reader, version)
+    assert {key: entry for _, key, entry in changes} == {
+        "at1": {"secret": "1"}, "at2": {"secret": "2"}}
+    writer.delete_entries([("AccessToken", "at1")])
+    version, changes = reader.changed_since(version)
+    assert changes == [("AccessToken", "at1", None)]
+    assert reader.changed_since(version)[1] == [], "Nothing changed since then"
+    assert reader.get_entry("AccessToken", "at1") is None
+    assert reader.get_entry("AccessToken", "at2") == {"secret": "2"}
+    assert json.loads(reader.load()) == {"AccessToken": {"at2": {"secret": "2"}}}
+
+@pytest.mark.parametrize("persistence_class", [SqlitePersistence, DirectoryPersistence])
+def test_entry_persistence_roundtrip(temp_location, persistence_class):
+    persistence = persistence_class(temp_location)
+    cache = {"AccessToken": {"at1": {"secret": "1"}}, "RefreshToken": {"rt": {}}}
+    persistence.save(json.dumps(cache))
+    assert json.loads(persistence.load()) == cache
+    del cache["RefreshToken"]
+    persistence.save(json.dumps(cache))
+    assert json.loads(persistence_class(temp_location).load()) == cache
+
+def test_nonexistent_directory_persistence(temp_location):
+    _test_nonexistent_persistence(DirectoryPersistence(temp_location))
+
+def test_reader_behind_a_replaced_change_log_starts_over(temp_location):
+    writer = DirectoryPersistence(temp_location)
+    writer.put_entries([("AccessToken", "at1", {})])
+    version, _ = DirectoryPersistence(temp_location).changed_since(None)
+    with patch("msal_extensions.directory_persistence._CHANGE_LOG_COMPACTION_THRESHOLD", 0):
+        writer.put_entries([("AccessToken", "at2", {})])
+    assert DirectoryPersistence(temp_location).changed_since(version)[1] is None
+
 def test_nonexistent_file_persistence(temp_location):
     _test_nonexistent_persistence(FilePersistence(temp_location))
+    with pytest.raises(PersistenceNotFound):
+        FilePersistence(temp_location, memory_map=True).load()
 
 @pytest.mark.skipif(
     not sys.platform.startswith('win'),
@@ -62,6 +228,72 @@ def test_file_persistence_with_data_protection(temp_location):
 def test_nonexistent_file_persistence_with_data_protection(temp_location):
     _test_nonexistent_persistence(FilePersistenceWithDataProtection(temp_location))
 
+def _symmetric_key_sources(temp_location):
+    key = os.urandom(32)
+    key_file = temp_location + ".key"
+    with open(key_file, "wb") as handle:
+        handle.write(base64.b64encode(key) + b"\n")
+    read_end, write_end = os.pipe()
+    os.write(write_end, base64.b64encode(key))
+    os.close(write_end)
+    yield {"key": key, "key_encoding": "raw"}
+    yield {"key_file": key_file}
+    yield {"key_fd": read_end}
+    os.close(read_end)
+    with patch.dict(os.environ, {"TEST_KEY": base64.b64encode(key).decode("ascii")}):
+        yield {"key_env": "TEST_KEY"}
+
+def test_file_persistence_with_symmetric_key(temp_location):
+    pytest.importorskip("cryptography")
+    persistences = [
+        FilePersistenceWithSymmetricKey(temp_location, **source)
+        for source in _symmetric_key_sources(temp_location)]
+    _test_persistence_roundtrip(persistences[0])
+    with open(temp_location, "rb") as handle:
+        assert b"arbitrary content" not in handle.read()
+    for persistence in persistences:  # A same key from different sources
+        assert persistence.is_encrypted
+        assert persistence.load() == 'arbitrary content'
+    compressed = FilePersistenceWithSymmetricKey(
+        temp_location, key=b"k" * 16, key_encoding="raw", compression="zlib")
+    _test_persistence_roundtrip(compressed)
+
+def test_file_persistence_with_wrong_symmetric_key(temp_location):
+    pytest.importorskip("cryptography")
+    FilePersistenceWithSymmetricKey(
+        temp_location, key=b"1" * 32, key_encoding="raw").save("content")
+    with pytest.raises(PersistenceDecryptionError):
+        FilePersistenceWithSymmetricKey(
+            temp_location, key=b"2" * 32, key_encoding="raw").load()
+    FilePersistence(temp_location).save("plaintext")
+    with pytest.raises(PersistenceDecryptionError):
+        FilePersistenceWithSymmetricKey(
+            temp_location, key=b"1" * 32, key_encoding="raw").load()
+    with pytest.raises(ValueError):
+        FilePersistenceWithSymmetricKey(
+            temp_location, key=b"too short", key_encoding="raw")
+
+def test_symmetric_key_is_decoded_by_its_declared_encoding(temp_location):
+    pytest.importorskip("cryptography")
+    ambiguous_key = b"A" * 32  # Also a valid base64 of 24 bytes
+    assert len(_parse_key(ambiguous_key, "raw")) == 32
+    assert len(_parse_key(ambiguous_key, "base64")) == 24
+    with pytest.raises(ValueError, match="key_encoding='raw'"):
+        FilePersistenceWithSymmetricKey(temp_location, key=os.urandom(31) + b"!")
+    with pytest.raises(ValueError):
+        FilePersistenceWithSymmetricKey(temp_location, key=b"k" * 32, key_encoding="hex")
+
+def test_nonexistent_file_persistence_with_symmetric_key(temp_location):
+    pytest.importorskip("cryptography")
+    _test_nonexistent_persistence(
+        FilePersistenceWithSymmetricKey(temp_location, key=b"k" * 32, key_encoding="raw"))
+
+def test_persistence_builder_with_symmetric_key(temp_location):
+    pytest.importorskip("cryptography")
+    persistence = build_encrypted_persistence(
+        temp_location, key=base64.b64encode(b"k" * 32))
+    assert isinstance(persistence, FilePersistenceWithSymmetricKey)
+
 @pytest.mark.skipif(
     not sys.platform.startswith('darwin'),
     reason="Requires OSX.")
@@ -0,0 +1,56 @@
+import json
+from unittest.mock import patch
+
+from msal_extensions import FilePersistence, ShardedPersistedTokenCache
+
+
+def _build_cache(temp_location, count=2):
+    persistences = [
+        FilePersistence("{}.{}".format(temp_location, i)) for i in range(count)]
+    return ShardedPersistedTokenCache(persistences), persistences
+
+def test_entries_are_partitioned_but_searchable_as_one_cache(temp_location, build_refresh_token):
+    cache, persistences = _build_cache(temp_location)
+    uids = ["alice", "bob", "carol", "dave"]
+    for uid in uids:
+        rt = build_refresh_token(uid)
+        cache.modify("RefreshToken", rt, rt)
+    stored = [
+        len(json.loads(p.load()).get("RefreshToken", {})) for p in persistences]
+    assert sum(stored) == len(uids) and all(stored), "Each shard should get some"
+    assert sorted(rt["home_account_id"] for rt in cache.search("RefreshToken")) == uids
+    another_cache, _ = _build_cache(temp_location)  # As if in another process
+    assert len(list(another_cache.search("RefreshToken"))) == len(uids)
+
+def test_search_by_home_account_id_reads_only_one_shard(temp_location, build_refresh_token):
+    cache, persistences = _build_cache(temp_location)
+    for uid in ("alice", "bob", "carol", "dave"):
+        rt = build_refresh_token(uid)
+        cache.modify("RefreshToken", rt, rt)
+    reader, reader_persistences = _build_cache(temp_location)
+    with patch.object(
+            reader_persistences[0], "load", wraps=reader_persistences[0].load
+            ) as load_0, patch.object(
+            reader_persistences[1], "load", wraps=reader_persistences[1].load
+            ) as load_1:
+        result = list(reader.search("RefreshToken", query={"home_account_id": "bob"}))
+    assert [rt["home_account_id"] for rt in result] == ["bob"]
+    assert load_0.call_count + load_1.call_count == 1
+
+def test_entries_without_shard_key_go_to_first_shard(temp_location):
+    cache, persistences = _build_cache(temp_location)
+    app_metadata = {"client_id": "my_client_id", "environment": "login.microsoftonline.com"}
+    cache.modify("AppMetadata", app_metadata, app_metadata)
+    assert "AppMetadata" in json.loads(persistences[0].load())
+    assert cache._get_app_metadata(
+        environment="login.microsoftonline.com", client_id="my_client_id")
+
+def test_serialize_merges_shards(temp_location, build_refresh_token):
+    cache, _ = _build_cache(temp_location)
+    for uid in ("alice", "bob", "carol"):
+        rt = build_refresh_token(uid)
+        cache.modify("RefreshToken", rt, rt)
+    state = cache.serialize()
+    another_cache, _ = _build_cache(temp_location + ".another", count=3)
+    another_cache.deserialize(state)
+    assert json.loads(another_cache.serialize()) == json.loads(state)
@@ -0,0 +1,56 @@
+import struct
+
+from msal_extensions import FilePersistence, PersistedTokenCache, SharedMemoryPersistence
+from msal_extensions import shared_memory
+
+
+def test_content_is_loaded_from_shared_memory(temp_location, unusable_persistence):
+    # Each process would have its own instance, mapping a same shared memory
+    writer = SharedMemoryPersistence(FilePersistence(temp_location))
+    reader = SharedMemoryPersistence(unusable_persistence(temp_location))
+    writer.save("first")
+    fingerprint = reader.fingerprint()
+    assert reader.load() == "first"
+    writer.save("second")
+    assert reader.fingerprint() != fingerprint
+    assert reader.load() == "second"
+    assert FilePersistence(temp_location).load() == "second", "File remains durable"
+
+
+def test_shared_memory_grows_for_larger_content(temp_location, unusable_persistence):
+    writer = SharedMemoryPersistence(FilePersistence(temp_location), capacity=8)
+    reader = SharedMemoryPersistence(unusable_persistence(temp_location), capacity=8)
+    writer.save("larger than 8 bytes")
+    assert reader.load() == "larger than 8 bytes"
+
+
+def test_torn_read_falls_back_to_file(temp_location):
+    persistence = SharedMemoryPersistence(FilePersistence(temp_location))
+    persistence.save("content")
+    # As if a writer crashed in the middle of a write
+    struct.pack_into("<Q", persistence._map, 8, 3)  # The sequence is odd
+    assert persistence.load() == "content"
+    persistence._map[shared_memory._HEADER.size] = ord("X")  # Checksum mismatch
+    struct.pack_into("<Q", persistence._map, 8, 4)
+    assert persistence.load() == "content"
+
+
+def test_shared_memory_left_behind_is_ignored_after_file_changed(temp_location):
+    SharedMemoryPersistence(FilePersistence(temp_location)).save("old")
+    FilePersistence(temp_location).save("changed without shared memory")
+    persistence = SharedMemoryPersistence(FilePersistence(temp_location))
+    assert persistence.load() == "changed without shared memory"
+
+
+def test_token_cache_sees_changes_published_by_another_instance(temp_location,
+        unusable_persistence):
+    writer = PersistedTokenCache(SharedMemoryPersistence(FilePersistence(temp_location)))
+    reader = PersistedTokenCache(
+        SharedMemoryPersistence(unusable_persistence(temp_location)))
+    writer.add({
+        "client_id": "my_client_id",
+        "scope": ["s2", "s1", "s3"],
+        "token_endpoint": "https://login.example.com/contoso/v2/token",
+        "response": {"access_token": "an access token", "expires_in": 3600},
+        })
+    assert len(list(reader.search("AccessToken", target=["s1"]))) == 1